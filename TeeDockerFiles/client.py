@@ -1,6 +1,7 @@
 import requests
 import logging
 import time
+import json
 import argparse
 
 # Configure logging
@@ -16,14 +17,18 @@ def main():
     parser.add_argument('--prompt', type=str, help='Text prompt to send to the model')
     parser.add_argument('--host', type=str, default='localhost', help='Host where the model is running')
     parser.add_argument('--port', type=int, default=5002, help='Port number for the model')  # Changed from 5000 to 5002
+    parser.add_argument('--stream', action='store_true', help='Print the response as it is generated')
     
     args = parser.parse_args()
     
     if args.prompt:
         # Run in single query mode
         logger.info(f"Running single query to model at {args.host}:{args.port}")
-        response = send_prompt(args.prompt, args.host, args.port)
-        print("\nResponse:", response)
+        if args.stream:
+            stream_prompt(args.prompt, args.host, args.port)
+        else:
+            response = send_prompt(args.prompt, args.host, args.port)
+            print("\nResponse:", response)
     else:
         # Run in interactive mode
         logger.info(f"Starting interactive session with model at {args.host}:{args.port}")
@@ -36,8 +41,11 @@ def main():
                 logger.info("Ending session")
                 break
                 
-            response = send_prompt(user_input, args.host, args.port)
-            print("\nResponse:", response)
+            if args.stream:
+                stream_prompt(user_input, args.host, args.port)
+            else:
+                response = send_prompt(user_input, args.host, args.port)
+                print("\nResponse:", response)
 
 def send_prompt(prompt, host='localhost', port=5002):  # Changed from 5000 to 5002
     """Send a prompt to the distributed model"""
@@ -69,5 +77,30 @@ def send_prompt(prompt, host='localhost', port=5002):  # Changed from 5000 to 50
         logger.error(f"Error: {str(e)}")
         return f"Error: {str(e)}"
 
+def stream_prompt(prompt, host='localhost', port=5002):
+    """Send a prompt and print the response text as it streams back"""
+    logger.info(f"Streaming prompt: {prompt}")
+    url = f"http://{host}:{port}/generate"
+    
+    try:
+        start_time = time.time()
+        print("\nResponse: ", end="", flush=True)
+        
+        with requests.post(url, json={"prompt": prompt, "stream": True}, stream=True, timeout=300) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                message = json.loads(line)
+                if "token" in message:
+                    print(message["token"], end="", flush=True)
+        
+        print()
+        logger.info(f"Response streamed in {time.time() - start_time:.2f}s")
+    
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Error: {str(e)}")
+        print(f"Error: {str(e)}")
+
 if __name__ == "__main__":
     main() 
\ No newline at end of file
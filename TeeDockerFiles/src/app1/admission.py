@@ -0,0 +1,166 @@
+import logging
+import math
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger('node1.admission')
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request cannot be admitted; carries the HTTP status and Retry-After"""
+
+    def __init__(self, message, status_code, retry_after):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a request runs past its deadline"""
+
+
+class Deadline:
+    """Absolute per-request deadline on the monotonic clock"""
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.expires_at = time.monotonic() + timeout
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return time.monotonic() >= self.expires_at
+
+    def check(self, stage):
+        if self.expired():
+            raise DeadlineExceeded(f"Deadline of {self.timeout:.0f}s exceeded during {stage}")
+
+
+class Ticket:
+    """Admission slot held by one running request; release() is idempotent"""
+
+    def __init__(self, controller, cost, deadline, queued_at):
+        self.controller = controller
+        self.cost = cost
+        self.deadline = deadline
+        self.queued_at = queued_at
+        self.started_at = None
+        self.admitted = False
+        self.released = False
+
+    def release(self):
+        self.controller._release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+
+class AdmissionController:
+    """
+    Bounded FIFO admission in front of the model.
+
+    A request costs prompt_tokens x max_new_tokens. It is admitted once fewer than
+    `max_concurrent` requests are running and the in-flight cost stays within
+    `token_budget` (a request larger than the whole budget runs alone). At most
+    `max_queue` requests wait; beyond that new requests get 429. A request whose
+    deadline passes while queued gets 503. Both carry a Retry-After estimate.
+    """
+
+    def __init__(self, max_concurrent=2, max_queue=16, token_budget=262144, ewma_alpha=0.2):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.token_budget = token_budget
+        self.ewma_alpha = ewma_alpha
+
+        self._cond = threading.Condition()
+        self._waiting = deque()
+        self._running = 0
+        self._in_flight_cost = 0
+
+        # Statistics reported on /health
+        self.admitted_total = 0
+        self.rejected_total = 0
+        self.expired_total = 0
+        self.avg_wait = 0.0
+        self.max_wait = 0.0
+        self.avg_service = 0.0
+
+    def _fits(self, ticket):
+        if self._running >= self.max_concurrent:
+            return False
+        return self._running == 0 or self._in_flight_cost + ticket.cost <= self.token_budget
+
+    def retry_after(self):
+        """Seconds a rejected client should wait, from queue depth and mean service time"""
+        service = self.avg_service or 1.0
+        return max(1, math.ceil(service * (len(self._waiting) + 1) / self.max_concurrent))
+
+    def acquire(self, cost, deadline):
+        """Block until admitted or raise AdmissionRejected"""
+        ticket = Ticket(self, cost, deadline, time.monotonic())
+        with self._cond:
+            if len(self._waiting) >= self.max_queue:
+                self.rejected_total += 1
+                raise AdmissionRejected("Request queue is full", 429, self.retry_after())
+
+            self._waiting.append(ticket)
+            try:
+                while not (self._waiting[0] is ticket and self._fits(ticket)):
+                    remaining = deadline.remaining()
+                    if remaining <= 0:
+                        self.expired_total += 1
+                        raise AdmissionRejected("Deadline expired while queued", 503, self.retry_after())
+                    self._cond.wait(remaining)
+            finally:
+                self._waiting.remove(ticket)
+                # The next waiter may now be at the head of the queue
+                self._cond.notify_all()
+
+            self._running += 1
+            self._in_flight_cost += cost
+            ticket.admitted = True
+            ticket.started_at = time.monotonic()
+
+            wait = ticket.started_at - ticket.queued_at
+            self.admitted_total += 1
+            self.avg_wait += self.ewma_alpha * (wait - self.avg_wait)
+            self.max_wait = max(self.max_wait, wait)
+
+        if wait > 0.01:
+            logger.info(f"Request admitted after {wait:.2f}s in queue (cost={cost})")
+        return ticket
+
+    def _release(self, ticket):
+        with self._cond:
+            if ticket.released or not ticket.admitted:
+                return
+            ticket.released = True
+            self._running -= 1
+            self._in_flight_cost -= ticket.cost
+            service = time.monotonic() - ticket.started_at
+            self.avg_service += self.ewma_alpha * (service - self.avg_service)
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            oldest_wait = time.monotonic() - self._waiting[0].queued_at if self._waiting else 0.0
+            return {
+                "queue_depth": len(self._waiting),
+                "max_queue": self.max_queue,
+                "running": self._running,
+                "max_concurrent": self.max_concurrent,
+                "in_flight_cost": self._in_flight_cost,
+                "token_budget": self.token_budget,
+                "avg_wait_s": round(self.avg_wait, 3),
+                "max_wait_s": round(self.max_wait, 3),
+                "oldest_wait_s": round(oldest_wait, 3),
+                "avg_service_s": round(self.avg_service, 3),
+                "admitted_total": self.admitted_total,
+                "rejected_total": self.rejected_total,
+                "expired_total": self.expired_total,
+            }
@@ -1,6 +1,6 @@
 import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM
-from flask import Flask, request, jsonify
+from transformers import AutoConfig, AutoTokenizer, AutoModelForCausalLM
+from flask import Flask, Response, request, jsonify, stream_with_context
 import requests
 import logging
 import time
@@ -13,7 +13,20 @@ import shutil
 import subprocess
 import sys
 import gdown
-from transformers.modeling_outputs import BaseModelOutputWithPast
+import uuid
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from transformers import DynamicCache
+from weight_store import load_shard_model
+from node1_model import Node1Model, make_layer_benchmark
+from tokenization import ChatTokenizer
+from admission import AdmissionController, AdmissionRejected, Deadline, DeadlineExceeded
+from routing import Node2Pool, NoReplicaAvailable
+from scheduling import StepScheduler
+from cpu_tuning import CpuTuner
+from compilation import ShardCompiler
+from attestation import AttestationAggregator, sha256_hex
+from model_registry import HostedModel, ModelLoading, ModelRegistry, ModelSpec, ModelUnavailable, UnknownModel
+from profiling import LayerProfiler, TraceCapture, create_profiling_blueprint, region
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -21,18 +34,22 @@ logger = logging.getLogger('node1')
 
 app = Flask(__name__)
 
+# CPU binding and inter-op pool size must be set before any parallel work starts
+cpu_tuner = CpuTuner.from_env()
+
 # For storing the model verification hash
 model_hash = None
 model_info = {}
 node1_latest_ra_data = None
 
-def get_ra_data(custom_data):
+def get_ra_data(custom_data, hash_algorithm="sha256"):
     """
     Call the Node script with custom data and return the RA report.
+    With hash_algorithm="raw", custom_data is hex used as the report data as is.
     """
     try:
         result = subprocess.run(
-            ["node", "generate_ra.js", custom_data],
+            ["node", "generate_ra.js", custom_data, hash_algorithm],
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
             check=True,
@@ -45,7 +62,7 @@ def get_ra_data(custom_data):
     except json.JSONDecodeError as je:
         return {"error": "Invalid JSON returned from Node script", "details": str(je)}
     
-def generate_model_hash(model):
+def generate_model_hash(model, model_name="TinyLlama-1.1B-Chat-v1.0"):
     """Generate a SHA-256 hash of model parameters and architecture"""
     logger.info("Generating model verification hash...")
     
@@ -69,7 +86,7 @@ def generate_model_hash(model):
     hash_data = {
         "architecture": model_arch,
         "parameters_sample": param_sample,
-        "model_name": "TinyLlama-1.1B-Chat-v1.0",
+        "model_name": model_name,
         "total_layers": len(model.model.layers),
         "node": "1"
     }
@@ -80,11 +97,10 @@ def generate_model_hash(model):
     
     return hash_result, hash_data
 
-def download_model_from_gdrive():
+def download_model_from_gdrive(model_dir="/app/models/tinyllama-1b", folder_id="1Iua1_n95NSgndooGFPfppaKTti5mmtEy"):
     """Download model files from Google Drive"""
     logger.info("Downloading model files from Google Drive")
     
-    model_dir = "/app/models/tinyllama-1b"
     os.makedirs(model_dir, exist_ok=True)
     
     try:
@@ -98,7 +114,7 @@ def download_model_from_gdrive():
     try:
         logger.info(f"Downloading entire model folder from Google Drive...")
         gdown.download_folder(
-            id="1Iua1_n95NSgndooGFPfppaKTti5mmtEy",
+            id=folder_id,
             output=model_dir,
             quiet=False
         )
@@ -109,52 +125,21 @@ def download_model_from_gdrive():
     
     return success
 
-# Create a custom class to modify the forward pass for Node1
-class Node1Model(torch.nn.Module):
-    def __init__(self, base_model, middle_layer):
-        super().__init__()
-        self.config = base_model.config
-        self.embed_tokens = base_model.model.embed_tokens
-        self.norm = base_model.model.norm
-        
-        # Only include the first half of layers
-        self.layers = base_model.model.layers[:middle_layer]
-        
-        logger.info(f"Node1 initialized with layers 0 to {middle_layer-1}")
-
-    def forward(self, input_ids, attention_mask=None, output_hidden_states=True):
-        # Get embeddings
-        hidden_states = self.embed_tokens(input_ids)
-
-        # Store all hidden states
-        all_hidden_states = () if output_hidden_states else None
-        
-        # Process through available layers
-        for idx, layer in enumerate(self.layers):
-            if output_hidden_states:
-                all_hidden_states = all_hidden_states + (hidden_states,)
-                
-            hidden_states = layer(hidden_states, attention_mask)[0]
-            
-        # Return the output and the hidden_states
-        return BaseModelOutputWithPast(
-            last_hidden_state=hidden_states,
-            hidden_states=all_hidden_states,
-            attentions=None,
-            past_key_values=None
-        )
-
-# Initialize model
-logger.info("Initializing Node1 (first half of model)...")
-model_name = "/app/models/tinyllama-1b"  # Local path in container
-
-# Try to download model files first
-if not download_model_from_gdrive():
-    logger.error("Failed to download model files. Trying to use local files if available.")
-
-try:
+def load_node1_model(spec):
+    """Load the tokenizer and the first half of the layers of a registry model"""
+    model_name = spec.path
+    if spec.gdrive_id and not os.path.exists(os.path.join(model_name, "config.json")):
+        if not download_model_from_gdrive(model_name, spec.gdrive_id):
+            logger.error("Failed to download model files. Trying to use local files if available.")
+    
     logger.info("Loading tokenizer from local directory...")
     tokenizer = AutoTokenizer.from_pretrained(model_name, local_files_only=True)
+    chat_tokenizer = ChatTokenizer(
+        tokenizer,
+        cache_size=int(os.environ.get("TOKENIZER_CACHE_SIZE", "1024")),
+        max_workers=int(os.environ.get("TOKENIZER_THREADS", "4")),
+        mode=os.environ.get("TOKENIZER_FAST_PATH", "exact")
+    )
     logger.info("Tokenizer loaded successfully")
     
     # Force garbage collection
@@ -162,14 +147,31 @@ try:
     if torch.cuda.is_available():
         torch.cuda.empty_cache()
     
-    logger.info("Loading model from local directory...")
-    full_model = AutoModelForCausalLM.from_pretrained(
-        model_name,
-        torch_dtype=torch.float16,
-        device_map="cpu",  # Initial CPU loading
-        low_cpu_mem_usage=True,
-        local_files_only=True
-    )
+    weight_store_dir = os.environ.get("WEIGHT_STORE_DIR")
+    if weight_store_dir:
+        # Map this node's weights read-only from a pre-converted file shared through the page cache
+        num_layers = AutoConfig.from_pretrained(model_name, local_files_only=True).num_hidden_layers
+        store_path = os.path.join(weight_store_dir, f"{os.path.basename(model_name)}-fp16.safetensors")
+        logger.info(f"Loading model from weight store {store_path}...")
+        full_model = load_shard_model(
+            model_name,
+            store_path,
+            layer_range=(0, num_layers // 2),
+            include_lm_head=False,
+            torch_dtype=torch.float16,
+            local_files_only=True,
+            attn_implementation="sdpa"
+        )
+    else:
+        logger.info("Loading model from local directory...")
+        full_model = AutoModelForCausalLM.from_pretrained(
+            model_name,
+            torch_dtype=torch.float16,
+            device_map="cpu",  # Initial CPU loading
+            low_cpu_mem_usage=True,
+            local_files_only=True,
+            attn_implementation="sdpa"  # Fused scaled-dot-product attention on CPU and GPU
+        )
     logger.info("Model loaded successfully")
     
     # Get the total layers and mid point
@@ -182,7 +184,7 @@ try:
     model = Node1Model(full_model, middle_layer)
     
     # Generate and store model hash
-    model_hash, model_info = generate_model_hash(full_model)
+    model_hash, model_info = generate_model_hash(full_model, spec.display_name)
     logger.info(f"Model verification hash: {model_hash}")
     
     # Release memory from the full model
@@ -195,29 +197,231 @@ try:
         memory_allocated = torch.cuda.memory_allocated() / (1024 ** 3)
         logger.info(f"Model moved to GPU. Memory used: {memory_allocated:.2f} GB")
     
+    return HostedModel(spec, model, model_hash, model_info, tokenizer=tokenizer, chat_tokenizer=chat_tokenizer)
+
+# Initialize model
+logger.info("Initializing Node1 (first half of model)...")
+default_spec = ModelSpec(
+    os.environ.get("DEFAULT_MODEL_ID", "tinyllama-1.1b-chat"),
+    "/app/models/tinyllama-1b",  # Local path in container
+    gdrive_id="1Iua1_n95NSgndooGFPfppaKTti5mmtEy",
+    display_name="TinyLlama-1.1B-Chat-v1.0"
+)
+
+# Try to download model files first
+if not download_model_from_gdrive(default_spec.path, default_spec.gdrive_id):
+    logger.error("Failed to download model files. Trying to use local files if available.")
+
+try:
+    default_model = load_node1_model(default_spec)
+    # Further models from MODEL_REGISTRY are loaded on first use and evicted under MODEL_MEMORY_BUDGET_GB
+    models = ModelRegistry.from_env(load_node1_model, "node1", default_model)
 except Exception as e:
     logger.error(f"Error loading model: {str(e)}")
     logger.error(traceback.format_exc())
     raise  # This will cause the container to exit on model load failure
 
+# The default model is the one compiled, tuned and profiled below
+model = default_model.model
+tokenizer = default_model.tokenizer
+chat_tokenizer = default_model.chat_tokenizer
+model_hash = default_model.model_hash
+model_info = default_model.model_info
+
+# Optional compiled graphs for norms and MLPs (COMPILE_MODE=inductor), before tuning so
+# the thread search times the path that serves requests
+shard_compiler = ShardCompiler.from_env()
+shard_compiler.compile(
+    model.layers, model_hash, model.config.hidden_size,
+    dtype=model.layers[0].parameters().__next__().dtype, device=model.layers[0].parameters().__next__().device
+)
+
+# Keep the thread count (and CPU set) that runs a decoder layer fastest on this host;
+# Node1 only runs prefill
+cpu_tuner.autotune(make_layer_benchmark(model.layers[0], model.rotary_emb, model.config, [(64, 1)]))
+
+# Admission control and per-request deadlines
+MAX_NEW_TOKENS = int(os.environ.get("MAX_NEW_TOKENS", "128"))
+REQUEST_TIMEOUT = float(os.environ.get("REQUEST_TIMEOUT", "300"))
+admission = AdmissionController(
+    max_concurrent=int(os.environ.get("ADMISSION_MAX_CONCURRENT", "2")),
+    max_queue=int(os.environ.get("ADMISSION_MAX_QUEUE", "16")),
+    token_budget=int(os.environ.get("ADMISSION_TOKEN_BUDGET", "262144"))
+)
+
+# Prompts longer than this are prefilled in chunks (0 disables chunking)
+PREFILL_CHUNK_SIZE = int(os.environ.get("PREFILL_CHUNK_SIZE", "256"))
+step_scheduler = StepScheduler()
+
+# Node2 replicas from NODE2_URLS / NODE2_URL and the optional NODE2_REGISTRY
+node2_pool = Node2Pool.from_env()
+node2_pool.start()
+
+# Requests attested within the window share one quote over a Merkle root of their records
+ATTESTATION_TIMEOUT = float(os.environ.get("ATTESTATION_TIMEOUT", "30"))
+attestations = AttestationAggregator(
+    get_ra_data,
+    window=float(os.environ.get("ATTESTATION_BATCH_WINDOW_MS", "200")) / 1000,
+    max_batch=int(os.environ.get("ATTESTATION_MAX_BATCH", "1024"))
+)
+
+# Opt-in profiling: per-layer forward hooks and torch.profiler traces under /admin/profile
+if os.environ.get("ENABLE_PROFILING", "0") == "1":
+    layer_profiler = LayerProfiler.for_layers(model.layers)
+    trace_capture = TraceCapture(os.environ.get("PROFILE_DIR", "/tmp/profiles"), "node1")
+    app.register_blueprint(create_profiling_blueprint(
+        layer_profiler, trace_capture, {"process_prompt", "generate"}, admin_token=os.environ.get("ADMIN_TOKEN")
+    ))
+    if os.environ.get("PROFILE_LAYERS", "0") == "1":
+        layer_profiler.enable()
+
 @app.route('/verify', methods=['GET'])
 def verify_model():
-    """Endpoint to verify the model's identity and integrity"""
-    if model_hash:
+    """Endpoint to verify the model's identity and integrity (?model= for a non-default model)"""
+    model_id = request.args.get("model") or models.default_model_id
+    if model_id not in models.specs:
+        return jsonify({"error": f"Unknown model: {model_id}", "status": "error"}), 404
+    hosted = models.get_loaded(model_id)
+    if hosted is None:
+        return jsonify({"model": model_id, "status": "not_loaded", "message": "Model is loaded on first use"})
+    if hosted.model_hash:
         response = {
-            "model_hash": model_hash,
+            "model": model_id,
+            "model_hash": hosted.model_hash,
             "model_info": {
-                "total_layers": len(model.layers),
-                "model_type": "TinyLlama-1.1B-Chat-v1.0 (Node1 - First Half)"
+                "total_layers": len(hosted.model.layers),
+                "model_type": f"{hosted.spec.display_name} (Node1 - First Half)"
             }
         }
         return jsonify(response)
     else:
         return jsonify({"error": "Model hash not available", "status": "error"}), 500
 
+def prefill_in_chunks(shard, input_ids, node2_session, node2_common, deadline):
+    """
+    Run the prompt through `shard`'s layers in PREFILL_CHUNK_SIZE-token chunks, filling a KV cache.
+
+    Each chunk's boundary activations are sent to Node2's /prefill on a background thread
+    while the next chunk is computed, so neither node materializes the whole prompt's
+    activations at once. Every chunk is one scheduler step, letting other requests run in
+    between. The final chunk is returned, not sent, to go out with the /generate request.
+    Returns (session_id or None when the prompt fits in one chunk, final chunk start, final chunk
+    activations, SHA-256 of the final chunk activations as float16 bytes).
+    """
+    prompt_length = input_ids.shape[1]
+    chunk_size = PREFILL_CHUNK_SIZE if PREFILL_CHUNK_SIZE > 0 else prompt_length
+    past_key_values = DynamicCache()
+    session_id = uuid.uuid4().hex if prompt_length > chunk_size else None
+    pending = []
+    
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefill-send") as sender:
+        for chunk_index, chunk_start in enumerate(range(0, prompt_length, chunk_size)):
+            deadline.check("prefill")
+            chunk_end = min(chunk_start + chunk_size, prompt_length)
+            position_ids = torch.arange(chunk_start, chunk_end, device=input_ids.device).unsqueeze(0)
+            
+            with step_scheduler.step(), torch.no_grad():
+                outputs = shard(
+                    input_ids[:, chunk_start:chunk_end],
+                    position_ids=position_ids,
+                    past_key_values=past_key_values,
+                    output_hidden_states=False
+                )
+            # Convert to list for JSON serialization
+            with region("node1.serialize"):
+                hidden_states_array = outputs.last_hidden_state.cpu().numpy()
+                hidden_states_list = hidden_states_array.tolist()
+            del outputs
+            
+            if chunk_end == prompt_length:
+                # Node2 hashes the same values on receipt, linking the two attestations
+                activations_hash = sha256_hex(hidden_states_array.tobytes())
+                break
+            
+            payload = dict(
+                node2_common,
+                session_id=session_id,
+                chunk_index=chunk_index,
+                hidden_states=hidden_states_list,
+                deadline_ms=int(deadline.remaining() * 1000)
+            )
+            pending.append(sender.submit(node2_session.post, "/prefill", payload, deadline.remaining()))
+            
+            # Stop early if an earlier chunk already failed
+            for future in [f for f in pending if f.done()]:
+                check_prefill_response(future.result())
+                pending.remove(future)
+        
+        for future in pending:
+            check_prefill_response(future.result())
+    
+    if session_id is not None:
+        logger.info(f"Prefilled {prompt_length} tokens in chunks of {chunk_size} (session {session_id})")
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    return session_id, chunk_start, hidden_states_list, activations_hash
+
+def check_prefill_response(response):
+    if response.status_code != 200:
+        raise RuntimeError(f"Node2 rejected prefill chunk: HTTP {response.status_code} {response.text[:200]}")
+
+def stream_from_node2(node2_session, node2_data, ra_future, start_time, deadline):
+    """
+    Relay Node2's line-delimited token stream, adding Node1's attestation to the final line.
+    Node2's 404/503/504 errors are returned with their status instead of a stream.
+    """
+    node2_data = dict(node2_data, stream=True)
+    lease = node2_session.post_stream("/generate", node2_data, timeout=deadline.remaining())
+    response = lease.response
+    if response.status_code in (404, 503, 504):
+        # Node2 refused the request before streaming; pass its error on as the non-streaming path does
+        status_code = response.status_code
+        try:
+            error_response = jsonify(response.json())
+        finally:
+            lease.release(success=status_code != 503)
+        error_response.status_code = status_code
+        return error_response
+    try:
+        response.raise_for_status()
+    except Exception:
+        lease.release(success=False)
+        raise
+
+    def relay():
+        try:
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                message = json.loads(line)
+                if "output" in message:
+                    # Final message: combine attestations as in the non-streaming path
+                    message.setdefault("attestation", {})["node1_attestation"] = collect_attestation(ra_future)
+                    logger.info(f"Total streamed request time: {time.time() - start_time:.2f}s")
+                yield json.dumps(message) + "\n"
+        finally:
+            lease.release()
+
+    return Response(stream_with_context(relay()), mimetype="application/x-ndjson")
+
+def collect_attestation(ra_future):
+    """Wait for this request's batched attestation and keep it for /node1_ra_report"""
+    global node1_latest_ra_data
+    try:
+        ra_data = ra_future.result(ATTESTATION_TIMEOUT)
+    except FutureTimeout:
+        return {"error": "Error generating RA report", "details": f"No quote within {ATTESTATION_TIMEOUT:.0f}s"}
+    except Exception as e:
+        return {"error": "Error generating RA report", "details": str(e)}
+    if "error" not in ra_data:
+        node1_latest_ra_data = ra_data
+    return ra_data
+
 @app.route('/process', methods=['POST'])
 def process_prompt():
     """Process a prompt through the first half of the model"""
+    ticket = None
+    hosted = None
     try:
         data = request.get_json()
         prompt = data.get("prompt", "")
@@ -225,76 +429,92 @@ def process_prompt():
         logger.info(f"Processing prompt: {prompt[:50]}..." if len(prompt) > 50 else f"Processing prompt: {prompt}")
         start_time = time.time()
         
-        # Format prompt with chat template
-        chat_prompt = tokenizer.apply_chat_template([{"role": "user", "content": prompt}], tokenize=False)
+        # Clients may ask for a shorter deadline or fewer tokens, never more than configured
+        deadline = Deadline(min(float(data.get("timeout", REQUEST_TIMEOUT)), REQUEST_TIMEOUT))
+        request_max_new_tokens = max(1, min(int(data.get("max_new_tokens", MAX_NEW_TOKENS)), MAX_NEW_TOKENS))
         
-        # Tokenize the input
-        input_ids = tokenizer.encode(chat_prompt, return_tensors="pt").to(model.layers[0].parameters().__next__().device)
-        attention_mask = torch.ones_like(input_ids)
-        logger.info(f"Input shape: {input_ids.shape}")
+        # The requested model, held until the request is done so it is not evicted. This never
+        # blocks: a model that is not loaded yet is loaded in the background while we return 503
+        hosted = models.acquire(data.get("model"))
+        shard = hosted.model
         
-        with torch.no_grad():
-            # Process through the first half of the model layers
-            outputs = model(input_ids, attention_mask=attention_mask, output_hidden_states=True)
-            
-            # Get the hidden states from the last processed layer
-            hidden_states = outputs.last_hidden_state
-            all_hidden_states = outputs.hidden_states
-            
-            logger.info(f"Hidden states shape: {hidden_states.shape}")
-            logger.info(f"Processed through {len(all_hidden_states)} layers")
-            
-            # Prepare key-value cache if needed for Node2
-            past_key_values = None
-            
-            # Convert to list for JSON serialization
-            hidden_states_list = hidden_states.cpu().numpy().tolist()
-            input_ids_list = input_ids.cpu().numpy().tolist()
-            
-            # Clean up memory
-            del outputs
-            if torch.cuda.is_available():
-                torch.cuda.empty_cache()
+        # Tokenize the input with the chat template applied (cached template segments)
+        with region("node1.tokenize"):
+            input_ids = torch.tensor(
+                [hosted.chat_tokenizer.encode(prompt)], dtype=torch.long, device=shard.layers[0].parameters().__next__().device
+            )
         
-        # Create serialized position IDs for continuation
-        position_ids = torch.arange(input_ids.shape[1], device=input_ids.device).unsqueeze(0)
-        position_ids_list = position_ids.cpu().numpy().tolist()
+        # Wait for an admission slot sized by prompt length x max_new_tokens
+        ticket = admission.acquire(input_ids.shape[1] * request_max_new_tokens, deadline)
+        deadline.check("queueing")
+        logger.info(f"Input shape: {input_ids.shape}")
+        prompt_length = input_ids.shape[1]
         
-        # Prepare data for node2
-        node2_data = {
-            "input_ids": input_ids_list,
-            "attention_mask": attention_mask.cpu().numpy().tolist(),
-            "position_ids": position_ids_list,
-            "hidden_states": hidden_states_list,
-            "prompt": chat_prompt,
+        # Every request to Node2 for this prompt goes to the same replica
+        node2_session = node2_pool.session()
+        
+        # Fields Node2 needs with every chunk as well as with the final request
+        node2_common = {
+            "model": hosted.model_id,
             "layer_info": {
-                "total_layers": len(model.layers),
-                "middle_layer": len(model.layers)  # This is the next layer Node2 should start from
+                "total_layers": len(shard.layers),
+                "middle_layer": len(shard.layers)  # This is the next layer Node2 should start from
             }
         }
         
+        # Process through the first half of the model layers, chunk by chunk for long prompts
+        session_id, last_start, hidden_states_list, activations_hash = prefill_in_chunks(
+            shard, input_ids, node2_session, node2_common, deadline
+        )
+        deadline.check("prefill")
+        
+        # Prepare data for node2: the final chunk, which Node2 continues into generation
+        node2_data = dict(
+            node2_common,
+            prompt_length=prompt_length,  # Node2 only detokenizes what it generates
+            attention_mask=[[1] * prompt_length],
+            position_ids=[list(range(last_start, prompt_length))],
+            hidden_states=hidden_states_list,
+            prompt=prompt,
+            max_new_tokens=request_max_new_tokens
+        )
+        if session_id is not None:
+            node2_data["session_id"] = session_id
+        
         logger.info("Sending processed data to node2...")
         node2_start = time.time()
         
-        # Get Node2 URL from environment variable with fallback
-        node2_url = os.environ.get('NODE2_URL', 'http://app2:5001')
-        generate_endpoint = f"{node2_url}/generate"
-        logger.info(f"Using Node2 endpoint: {generate_endpoint}")
+        # Attest this request's record; the quote is generated in a batch while Node2 works
+        logger.info("Queueing remote attestation for processed output...")
+        ra_future = attestations.submit({
+            "node": "node1",
+            "model": hosted.model_id,
+            "model_hash": hosted.model_hash,
+            "layers": f"0-{len(shard.layers)-1}",
+            "prompt_hash": sha256_hex(prompt),
+            "prompt_tokens": prompt_length,
+            "output_hash": activations_hash,
+            # Earlier prefill chunks went to Node2 unattested; the hash covers these positions only
+            "output_positions": [last_start, prompt_length],
+            "timestamp": time.time()
+        })
         
-        # Generate RA data using the processed data as custom data
-        logger.info("Generating remote attestation data for processed output...")
-        ra_custom_data = f"node1_process:prompt={prompt[:50]}...,hidden_states_shape={len(hidden_states_list)}x{len(hidden_states_list[0]) if hidden_states_list else 0},time:{time.time()},layers:0-{len(model.layers)-1}"
-        ra_data = get_ra_data(ra_custom_data)
+        # Node2 stops generating once the remaining time runs out
+        deadline.check("attestation")
+        node2_data["deadline_ms"] = int(deadline.remaining() * 1000)
         
-        # Store the RA data in the global variable for the new endpoint to access
-        global node1_latest_ra_data
-        node1_latest_ra_data = ra_data
+        if data.get("stream", False):
+            response = stream_from_node2(node2_session, node2_data, ra_future, start_time, deadline)
+            # The slot is held until the client has received the whole stream
+            response.call_on_close(ticket.release)
+            ticket = None
+            return response
         
-        # Send to node2 for completion
-        response = requests.post(
-            generate_endpoint,
-            json=node2_data,
-            timeout=300  # 5 minute timeout
+        # Send to the least-loaded Node2 replica (or the one holding our prefill chunks)
+        response = node2_session.post(
+            "/generate",
+            node2_data,
+            timeout=deadline.remaining()
         )
         
         node2_time = time.time() - node2_start
@@ -305,8 +525,11 @@ def process_prompt():
         
         # Get the response from node2
         node2_response = response.json()
+        if response.status_code in (404, 503, 504):
+            return jsonify(node2_response), response.status_code
         
         # Add the RA data to the response
+        ra_data = collect_attestation(ra_future)
         if "attestation" in node2_response:
             # If node2 already has attestation data, combine both
             node2_response["attestation"]["node1_attestation"] = ra_data
@@ -316,10 +539,32 @@ def process_prompt():
         
         return jsonify(node2_response)
         
+    except UnknownModel as e:
+        return jsonify({"output": f"Error: {str(e)}", "status": "unknown_model"}), 404
+    except ModelLoading as e:
+        logger.info(str(e))
+        return jsonify({"output": f"Error: {str(e)}", "status": "loading"}), 503, {"Retry-After": str(e.retry_after)}
+    except ModelUnavailable as e:
+        logger.error(f"Model unavailable: {str(e)}")
+        return jsonify({"output": f"Error: {str(e)}", "status": "unavailable"}), 503
+    except AdmissionRejected as e:
+        logger.warning(f"Request rejected ({e.status_code}): {str(e)}")
+        return jsonify({"output": f"Error: {str(e)}", "status": "rejected"}), e.status_code, {"Retry-After": str(e.retry_after)}
+    except NoReplicaAvailable as e:
+        logger.error(f"No Node2 replica available: {str(e)}")
+        return jsonify({"output": f"Error: {str(e)}", "status": "unavailable"}), 503, {"Retry-After": str(e.retry_after or int(node2_pool.probe_interval))}
+    except (DeadlineExceeded, requests.exceptions.Timeout) as e:
+        logger.warning(f"Request timed out: {str(e)}")
+        return jsonify({"output": f"Error: {str(e)}", "status": "timeout"}), 504
     except Exception as e:
         logger.error(f"Error processing prompt: {str(e)}")
         logger.error(traceback.format_exc())
         return jsonify({"output": f"Error: {str(e)}"})
+    finally:
+        if ticket is not None:
+            ticket.release()
+        if hosted is not None:
+            models.release(hosted)
       
 @app.route('/generate', methods=['POST'])
 def generate():
@@ -348,8 +593,16 @@ def health():
     """Health check endpoint"""
     return jsonify({
         "status": "ok",
-        "model_type": "TinyLlama-1.1B-Chat-v1.0 (Node1)",
+        "model_type": f"{default_model.spec.display_name} (Node1)",
         "layers": f"0-{len(model.layers)-1}",
+        "admission": admission.stats(),
+        "scheduler": step_scheduler.stats(),
+        "cpu": cpu_tuner.stats(),
+        "compilation": shard_compiler.stats(),
+        "node2_pool": node2_pool.stats(),
+        "tokenizer": chat_tokenizer.stats(),
+        "attestation": attestations.stats(),
+        "models": models.stats(),
         "memory_usage": f"{torch.cuda.memory_allocated() / (1024 ** 3):.2f} GB" if torch.cuda.is_available() else "CPU only"
     })
 
@@ -0,0 +1,127 @@
+import logging
+import os
+import time
+
+import torch
+import torch.nn.functional as F
+
+logger = logging.getLogger('compilation')
+
+# Blocks of a decoder layer that act on each position independently
+POSITIONWISE_BLOCKS = ("input_layernorm", "post_attention_layernorm", "mlp")
+
+
+def _set_recompile_limit(limit):
+    # Renamed from cache_size_limit in newer releases
+    for name in ("recompile_limit", "cache_size_limit", "accumulated_recompile_limit", "accumulated_cache_size_limit"):
+        if hasattr(torch._dynamo.config, name):
+            setattr(torch._dynamo.config, name, max(getattr(torch._dynamo.config, name), limit))
+
+
+def make_bucketed_forward(compiled, eager, buckets):
+    """
+    Run a position-wise forward through `compiled` at fixed sequence lengths: one token
+    (decode) as is, longer inputs zero-padded up to the next bucket and sliced back.
+    Padding rows never mix with real ones in these blocks. Inputs longer than the largest
+    bucket run eagerly.
+    """
+    def forward(hidden_states):
+        length = hidden_states.shape[-2]
+        if length == 1:
+            return compiled(hidden_states)
+        bucket = next((b for b in buckets if b >= length), None)
+        if bucket is None:
+            return eager(hidden_states)
+        if bucket != length:
+            hidden_states = F.pad(hidden_states, (0, 0, 0, bucket - length))
+        return compiled(hidden_states)[..., :length, :]
+
+    return forward
+
+
+class ShardCompiler:
+    """
+    Optional torch.compile (inductor) graphs for a shard's norms and MLPs.
+
+    Attention and the KV cache stay eager (SDPA is already a fused kernel, and the cache
+    grows every step), while RMSNorm and the gated MLP, where eager mode launches many
+    small ops, are compiled for the decode shape and each prefill bucket. The forward is
+    replaced on each module instance, so parameter names, the model hash and any hooks
+    are unchanged. Graphs are compiled at startup; the inductor cache lives in a
+    per-model directory, so warm restarts reuse the generated kernels.
+    """
+
+    def __init__(self, mode="none", buckets=(16, 32, 64, 128, 256), cache_dir="/app/compile_cache"):
+        self.mode = mode
+        self.buckets = sorted(buckets)
+        self.cache_dir = cache_dir
+        self.modules = []
+        self.report = {"mode": mode}
+
+    @classmethod
+    def from_env(cls):
+        buckets = os.environ.get("COMPILE_BUCKETS", "16,32,64,128,256")
+        return cls(
+            mode=os.environ.get("COMPILE_MODE", "none"),
+            buckets=[int(b) for b in buckets.split(",") if b.strip()],
+            cache_dir=os.environ.get("COMPILE_CACHE_DIR", "/app/compile_cache"),
+        )
+
+    def compile(self, layers, model_hash, hidden_size, dtype, device, extra=None):
+        """Compile the position-wise blocks of `layers` (plus `extra` modules) and warm them up"""
+        if self.mode == "none":
+            return self.stats()
+        if self.mode != "inductor":
+            raise ValueError(f"Unknown COMPILE_MODE: {self.mode}")
+
+        # Generated kernels are keyed by model so a different checkpoint never reuses them
+        inductor_dir = os.path.join(self.cache_dir, (model_hash or "unknown")[:16])
+        os.makedirs(inductor_dir, exist_ok=True)
+        os.environ["TORCHINDUCTOR_CACHE_DIR"] = inductor_dir
+        if hasattr(torch._inductor.config, "fx_graph_cache"):
+            torch._inductor.config.fx_graph_cache = True
+
+        modules = [getattr(layer, name) for layer in layers for name in POSITIONWISE_BLOCKS if hasattr(layer, name)]
+        modules += list(extra or [])
+        _set_recompile_limit(len(modules) * (len(self.buckets) + 1))
+
+        started = time.perf_counter()
+        try:
+            for module in modules:
+                eager = module.forward
+                compiled = torch.compile(eager, backend="inductor", dynamic=False)
+                module.forward = make_bucketed_forward(compiled, eager, self.buckets)
+                self.modules.append(module)
+            self._warm_up(hidden_size, dtype, device)
+        except Exception as e:
+            logger.error(f"Compilation failed, running eagerly: {str(e)}")
+            self.restore()
+            self.report = {"mode": "none", "requested_mode": self.mode, "error": str(e)}
+            return self.stats()
+
+        self.report = {
+            "mode": self.mode,
+            "buckets": self.buckets,
+            "compiled_modules": len(self.modules),
+            "compile_s": round(time.perf_counter() - started, 2),
+            "cache_dir": inductor_dir,
+        }
+        logger.info(f"Compiled {len(self.modules)} modules for decode and buckets {self.buckets} "
+                    f"in {self.report['compile_s']}s (cache {inductor_dir})")
+        return self.stats()
+
+    def _warm_up(self, hidden_size, dtype, device):
+        with torch.no_grad():
+            for length in [1] + self.buckets:
+                hidden_states = torch.zeros(1, length, hidden_size, dtype=dtype, device=device)
+                for module in self.modules:
+                    module(hidden_states)
+
+    def restore(self):
+        """Put the eager forwards back"""
+        for module in self.modules:
+            module.__dict__.pop("forward", None)
+        self.modules = []
+
+    def stats(self):
+        return dict(self.report)
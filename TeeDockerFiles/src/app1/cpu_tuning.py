@@ -0,0 +1,185 @@
+import glob
+import logging
+import os
+import statistics
+import time
+
+import torch
+
+logger = logging.getLogger('cpu_tuning')
+
+
+def parse_cpulist(text):
+    """Parse a Linux cpulist such as "0-3,8,10-11" into a sorted list of CPU ids"""
+    cpus = set()
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        if "-" in part:
+            first, last = part.split("-")
+            cpus.update(range(int(first), int(last) + 1))
+        else:
+            cpus.add(int(part))
+    return sorted(cpus)
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def available_cpus():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def numa_nodes(cpus):
+    """NUMA node id -> CPUs of `cpus` on that node; empty when the topology is not exposed"""
+    nodes = {}
+    for path in glob.glob("/sys/devices/system/node/node[0-9]*/cpulist"):
+        node = int(os.path.basename(os.path.dirname(path))[4:])
+        node_cpus = [c for c in parse_cpulist(_read(path) or "") if c in cpus]
+        if node_cpus:
+            nodes[node] = node_cpus
+    return nodes
+
+
+def core_of(cpu):
+    """Hyperthread siblings sharing `cpu`'s physical core"""
+    siblings = _read(f"/sys/devices/system/cpu/cpu{cpu}/topology/thread_siblings_list")
+    return tuple(parse_cpulist(siblings)) if siblings else (cpu,)
+
+
+def pin_process(cpus):
+    """Restrict every thread of this process (and threads it starts later) to `cpus`"""
+    if not hasattr(os, "sched_setaffinity"):
+        return False
+    for task in os.listdir("/proc/self/task"):
+        try:
+            os.sched_setaffinity(int(task), cpus)
+        except OSError:
+            pass  # Thread exited meanwhile
+    return True
+
+
+def thread_candidates(cpus):
+    """Powers of two below the CPU count, plus the physical core count and the CPU count"""
+    count = len(cpus)
+    candidates = {count, len({core_of(c) for c in cpus})}
+    n = 1
+    while n < count:
+        candidates.add(n)
+        n *= 2
+    return sorted(candidates)
+
+
+class CpuTuner:
+    """
+    Choose the CPU set and intra-op thread count each node runs its forward passes with.
+
+    At startup the process is bound to CPU_AFFINITY (a cpulist) or NUMA_NODE if given,
+    and the inter-op pool is sized once (it cannot be resized after first use, and the
+    step scheduler runs one forward at a time, so it stays small). After the model is
+    loaded, `autotune` times a decoder layer forward for each NUMA node's CPUs (when
+    there are several) and the whole CPU set, at several thread counts, then keeps the
+    fastest. TORCH_THREADS skips the search. Binding moves threads, not memory: pages
+    already touched (e.g. the weights) stay where they were first allocated.
+    """
+
+    def __init__(self, cpu_affinity=None, numa_node=None, interop_threads=1, threads=None,
+                 autotune_enabled=True, repeats=5, warmup=2):
+        self.threads = threads
+        self.autotune_enabled = autotune_enabled
+        self.repeats = repeats
+        self.warmup = warmup
+        self.results = []
+        self.report = {"source": "default"}
+
+        cpus = available_cpus()
+        if cpu_affinity:
+            cpus = [c for c in parse_cpulist(cpu_affinity) if c in cpus] or cpus
+        elif numa_node is not None:
+            cpus = numa_nodes(cpus).get(numa_node, cpus)
+        if cpus != available_cpus() and pin_process(cpus):
+            logger.info(f"Bound to CPUs {cpus}")
+        self.cpus = cpus
+        self.numa_node_count = len(numa_nodes(cpus)) or 1
+
+        if interop_threads:
+            try:
+                torch.set_num_interop_threads(interop_threads)
+            except RuntimeError as e:
+                logger.warning(f"Could not set inter-op threads: {str(e)}")
+        if threads:
+            torch.set_num_threads(threads)
+            self.report["source"] = "TORCH_THREADS"
+
+    @classmethod
+    def from_env(cls):
+        numa_node = os.environ.get("NUMA_NODE")
+        threads = os.environ.get("TORCH_THREADS")
+        return cls(
+            cpu_affinity=os.environ.get("CPU_AFFINITY"),
+            numa_node=int(numa_node) if numa_node else None,
+            interop_threads=int(os.environ.get("TORCH_INTEROP_THREADS", "1")),
+            threads=int(threads) if threads else None,
+            autotune_enabled=os.environ.get("CPU_AUTOTUNE", "1") == "1",
+        )
+
+    def _time(self, benchmark):
+        for _ in range(self.warmup):
+            benchmark()
+        samples = []
+        for _ in range(self.repeats):
+            started = time.perf_counter()
+            benchmark()
+            samples.append(time.perf_counter() - started)
+        return statistics.median(samples)
+
+    def autotune(self, benchmark):
+        """Time `benchmark` (a layer forward) for each CPU set and thread count and keep the best"""
+        if self.threads or not self.autotune_enabled:
+            return self.stats()
+        if torch.cuda.is_available():
+            self.report["source"] = "skipped (CUDA)"
+            return self.stats()
+
+        cpu_sets = {"all": self.cpus}
+        nodes = numa_nodes(self.cpus)
+        if len(nodes) > 1:
+            cpu_sets.update({f"numa{node}": node_cpus for node, node_cpus in nodes.items()})
+
+        started = time.perf_counter()
+        best = None
+        for label, cpus in cpu_sets.items():
+            pin_process(cpus)
+            for threads in thread_candidates(cpus):
+                torch.set_num_threads(threads)
+                latency = self._time(benchmark)
+                self.results.append({"cpus": label, "threads": threads, "latency_ms": round(1000 * latency, 3)})
+                if best is None or latency < best[0]:
+                    best = (latency, label, cpus, threads)
+
+        latency, label, cpus, threads = best
+        pin_process(cpus)
+        torch.set_num_threads(threads)
+        self.cpus = cpus
+        self.numa_node_count = len(numa_nodes(cpus)) or 1
+        self.report = {"source": "autotune", "cpu_set": label, "latency_ms": round(1000 * latency, 3),
+                       "tuning_s": round(time.perf_counter() - started, 2)}
+        logger.info(f"CPU autotune picked {threads} threads on {label} CPUs ({1000 * latency:.2f} ms per layer forward)")
+        return self.stats()
+
+    def stats(self):
+        return dict(
+            self.report,
+            cpus=len(self.cpus),
+            numa_nodes=self.numa_node_count,
+            intra_op_threads=torch.get_num_threads(),
+            inter_op_threads=torch.get_num_interop_threads(),
+            candidates=self.results,
+        )
@@ -4,12 +4,16 @@ const { TappdClient } = require('@phala/dstack-sdk');
   try {
     // Read custom data from the command-line argument
     const userData = process.argv[2] || "default-user-data";
+    // 'raw' embeds hex-encoded report data (e.g. a Merkle root) without hashing it
+    const hashAlgorithm = process.argv[3] || 'sha256';
+    // The SDK hex-encodes a string's UTF-8, so raw hex must be passed as the bytes it encodes
+    const reportData = hashAlgorithm === 'raw' ? Buffer.from(userData, 'hex') : userData;
     
     const client = new TappdClient();
     await client.info();
     
-    // Generate a TDX quote using the provided custom data and SHA256.
-    const quoteResult = await client.tdxQuote(userData, 'sha256');
+    // Generate a TDX quote using the provided custom data and hash algorithm.
+    const quoteResult = await client.tdxQuote(reportData, hashAlgorithm);
     
     // Build the RA report.
     const raReport = {
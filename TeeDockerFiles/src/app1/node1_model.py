@@ -0,0 +1,128 @@
+import inspect
+import logging
+
+import torch
+from transformers.modeling_outputs import BaseModelOutputWithPast
+from transformers.models.llama.modeling_llama import LlamaDecoderLayer
+
+logger = logging.getLogger('node1')
+
+# Decoder layers take the KV cache as `past_key_values` in newer transformers releases
+# and as `past_key_value` in older ones
+CACHE_KWARG = (
+    "past_key_values"
+    if "past_key_values" in inspect.signature(LlamaDecoderLayer.forward).parameters
+    else "past_key_value"
+)
+
+def build_causal_mask(attention_mask, query_length, dtype, attn_implementation=None):
+    """
+    Build the 4-D additive causal mask [batch, 1, query, key] shared by every layer.
+
+    `attention_mask` is the 2-D 0/1 mask over all key positions (cached + current).
+    Returns None when SDPA can apply causality itself, which lets it pick a fused kernel.
+    """
+    key_length = attention_mask.shape[-1]
+    past_length = key_length - query_length
+    no_padding = bool(attention_mask.all())
+
+    if attn_implementation == "sdpa" and no_padding and (past_length == 0 or query_length == 1):
+        return None
+
+    device = attention_mask.device
+    query_positions = torch.arange(past_length, key_length, device=device).unsqueeze(-1)
+    key_positions = torch.arange(key_length, device=device).unsqueeze(0)
+    allowed = (key_positions <= query_positions).unsqueeze(0).unsqueeze(0)
+    allowed = allowed & attention_mask[:, None, None, :].bool()
+
+    mask = torch.zeros(allowed.shape, dtype=dtype, device=device)
+    return mask.masked_fill(~allowed, torch.finfo(dtype).min)
+
+def run_decoder_layer(layer, hidden_states, causal_mask, position_ids, position_embeddings, past_key_values=None):
+    """Run one decoder layer with the shared mask and rotary embeddings"""
+    layer_kwargs = {
+        "attention_mask": causal_mask,
+        "position_ids": position_ids,
+        "position_embeddings": position_embeddings,
+        "use_cache": past_key_values is not None,
+        CACHE_KWARG: past_key_values,
+    }
+    layer_outputs = layer(hidden_states, **layer_kwargs)
+    # Older releases return a tuple, newer ones return the hidden states tensor
+    return layer_outputs[0] if isinstance(layer_outputs, tuple) else layer_outputs
+
+def make_layer_benchmark(layer, rotary_emb, config, workload):
+    """
+    Return a function running `layer` once per (seq_length, count) entry of `workload`,
+    on fixed random activations, for timing thread settings on this host.
+    """
+    param = next(layer.parameters())
+    inputs = []
+    for seq_length, count in workload:
+        hidden_states = torch.randn(1, seq_length, config.hidden_size, dtype=param.dtype, device=param.device)
+        position_ids = torch.arange(seq_length, device=param.device).unsqueeze(0)
+        causal_mask = build_causal_mask(
+            torch.ones((1, seq_length), dtype=torch.long, device=param.device), seq_length, param.dtype,
+            getattr(config, "_attn_implementation", None)
+        )
+        inputs.append((count, hidden_states, causal_mask, position_ids, rotary_emb(hidden_states, position_ids)))
+
+    def benchmark():
+        with torch.no_grad():
+            for count, hidden_states, causal_mask, position_ids, position_embeddings in inputs:
+                for _ in range(count):
+                    run_decoder_layer(layer, hidden_states, causal_mask, position_ids, position_embeddings)
+
+    return benchmark
+
+# Create a custom class to modify the forward pass for Node1
+class Node1Model(torch.nn.Module):
+    def __init__(self, base_model, middle_layer):
+        super().__init__()
+        self.config = base_model.config
+        self.embed_tokens = base_model.model.embed_tokens
+        self.norm = base_model.model.norm
+        # Rotary embeddings are computed once per step and shared by all layers
+        self.rotary_emb = base_model.model.rotary_emb
+        
+        # Only include the first half of layers
+        self.layers = base_model.model.layers[:middle_layer]
+        
+        logger.info(f"Node1 initialized with layers 0 to {middle_layer-1}")
+
+    def forward(self, input_ids, attention_mask=None, position_ids=None, past_key_values=None, output_hidden_states=True):
+        # Get embeddings
+        hidden_states = self.embed_tokens(input_ids)
+        batch_size, seq_length = input_ids.shape
+        past_length = past_key_values.get_seq_length() if past_key_values is not None else 0
+
+        if attention_mask is None:
+            attention_mask = torch.ones((batch_size, past_length + seq_length), dtype=torch.long, device=input_ids.device)
+        if position_ids is None:
+            position_ids = torch.arange(past_length, past_length + seq_length, device=input_ids.device).unsqueeze(0)
+
+        # Build the causal mask and rotary cos/sin once for all layers
+        causal_mask = build_causal_mask(
+            attention_mask, seq_length, hidden_states.dtype, getattr(self.config, "_attn_implementation", None)
+        )
+        position_embeddings = self.rotary_emb(hidden_states, position_ids)
+
+        # Store all hidden states
+        all_hidden_states = () if output_hidden_states else None
+        
+        # Process through available layers
+        for idx, layer in enumerate(self.layers):
+            if output_hidden_states:
+                all_hidden_states = all_hidden_states + (hidden_states,)
+                
+            hidden_states = run_decoder_layer(
+                layer, hidden_states, causal_mask, position_ids, position_embeddings, past_key_values
+            )
+            
+        # Return the output and the hidden_states
+        return BaseModelOutputWithPast(
+            last_hidden_state=hidden_states,
+            hidden_states=all_hidden_states,
+            attentions=None,
+            past_key_values=past_key_values
+        )
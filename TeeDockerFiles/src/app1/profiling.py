@@ -0,0 +1,336 @@
+import functools
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import nullcontext
+
+import torch
+from flask import Blueprint, jsonify, request, send_file
+
+logger = logging.getLogger('profiling')
+
+# Set on the thread whose request is being traced, so labels cost nothing elsewhere
+_local = threading.local()
+
+
+def region(name):
+    """Label a stage (tokenization, serialization, sampling...) in captured traces"""
+    if getattr(_local, "tracing", False):
+        return torch.profiler.record_function(name)
+    return nullcontext()
+
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def rss_bytes():
+    """Resident set size of this process from /proc/self/statm, or None where unavailable"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _tensor_bytes(output):
+    if isinstance(output, (tuple, list)):
+        output = output[0] if output else None
+    if isinstance(output, torch.Tensor):
+        return output.numel() * output.element_size()
+    return 0
+
+
+class LayerProfiler:
+    """
+    Per-module forward timing through forward hooks, installed only while enabled.
+
+    Covers each decoder layer and its attention and MLP blocks, plus any extra modules
+    (e.g. the final norm and lm_head), recording call count, wall time, output size and
+    the memory growth across the forward: the CUDA allocation delta on GPU, otherwise the
+    process RSS delta. RSS is process-wide, so concurrent requests add to each other's
+    figures, and memory the CPU allocator reuses does not show up. With profiling disabled
+    no hooks are registered, so the forward pass is untouched.
+    """
+
+    def __init__(self, modules):
+        self.modules = modules
+        self.enabled = False
+        self._handles = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._stats = {}
+        self._cuda = torch.cuda.is_available()
+        if self._cuda:
+            self.memory_metric = "cuda_allocated"
+        else:
+            self.memory_metric = "process_rss" if rss_bytes() is not None else None
+
+    @classmethod
+    def for_layers(cls, layers, first_index=0, extra=None):
+        """Profile decoder `layers`, named by their index in the full model"""
+        modules = {}
+        for offset, layer in enumerate(layers):
+            name = f"layers.{first_index + offset}"
+            modules[name] = layer
+            for block in ("self_attn", "mlp"):
+                if hasattr(layer, block):
+                    modules[f"{name}.{block}"] = getattr(layer, block)
+        modules.update(extra or {})
+        return cls(modules)
+
+    def enable(self):
+        with self._lock:
+            if self.enabled:
+                return
+            for name, module in self.modules.items():
+                self._handles.append(module.register_forward_pre_hook(functools.partial(self._before, name)))
+                self._handles.append(module.register_forward_hook(functools.partial(self._after, name)))
+            self.enabled = True
+        logger.info(f"Layer profiling enabled on {len(self.modules)} modules")
+
+    def disable(self):
+        with self._lock:
+            for handle in self._handles:
+                handle.remove()
+            self._handles = []
+            self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+    def _before(self, name, module, args):
+        if self._cuda:
+            torch.cuda.synchronize()
+        starts = getattr(self._local, "starts", None)
+        if starts is None:
+            starts = self._local.starts = {}
+        starts[name] = (time.perf_counter(), self._memory())
+
+    def _memory(self):
+        if self._cuda:
+            return torch.cuda.memory_allocated()
+        return rss_bytes() or 0
+
+    def _after(self, name, module, args, output):
+        started = getattr(self._local, "starts", {}).pop(name, None)
+        if started is None:
+            return
+        if self._cuda:
+            torch.cuda.synchronize()
+        elapsed = time.perf_counter() - started[0]
+        alloc_delta = self._memory() - started[1]
+        output_bytes = _tensor_bytes(output)
+
+        with self._lock:
+            stats = self._stats.setdefault(name, {"calls": 0, "total_s": 0.0, "max_s": 0.0, "output_bytes": 0, "alloc_delta_bytes": 0})
+            stats["calls"] += 1
+            stats["total_s"] += elapsed
+            stats["max_s"] = max(stats["max_s"], elapsed)
+            stats["output_bytes"] += output_bytes
+            stats["alloc_delta_bytes"] = max(stats["alloc_delta_bytes"], alloc_delta)
+
+    def stats(self):
+        with self._lock:
+            modules = {}
+            totals = {"layers_ms": 0.0, "attention_ms": 0.0, "mlp_ms": 0.0}
+            for name, s in self._stats.items():
+                modules[name] = {
+                    "calls": s["calls"],
+                    "total_ms": round(1000 * s["total_s"], 3),
+                    "avg_ms": round(1000 * s["total_s"] / s["calls"], 3),
+                    "max_ms": round(1000 * s["max_s"], 3),
+                    "avg_output_kb": round(s["output_bytes"] / s["calls"] / 1024, 1),
+                }
+                if self.memory_metric:
+                    modules[name]["max_alloc_delta_mb"] = round(s["alloc_delta_bytes"] / (1024 ** 2), 2)
+                if name.endswith(".self_attn"):
+                    totals["attention_ms"] += 1000 * s["total_s"]
+                elif name.endswith(".mlp"):
+                    totals["mlp_ms"] += 1000 * s["total_s"]
+                elif name.startswith("layers."):
+                    totals["layers_ms"] += 1000 * s["total_s"]
+            return {
+                "enabled": self.enabled,
+                # What max_alloc_delta_mb measures: CUDA allocations, or process RSS on CPU
+                "memory_metric": self.memory_metric,
+                "totals": {k: round(v, 3) for k, v in totals.items()},
+                "modules": modules,
+            }
+
+
+class TraceCapture:
+    """
+    Capture torch.profiler traces of the next N requests into one Chrome trace file.
+
+    The profiler only records the thread that started it and only one can run per
+    process, so each captured request is profiled on its own handler thread, one at a
+    time; requests that overlap a capture run unprofiled. The per-request traces are
+    merged into a single file with one process row per request.
+    """
+
+    def __init__(self, output_dir, node_name):
+        self.output_dir = output_dir
+        self.node_name = node_name
+        self._lock = threading.Lock()
+        self._remaining = 0
+        self._options = {}
+        self._active = None
+        self._active_thread = None
+        self._active_label = None
+        self._parts = []
+        self.path = None
+        self.armed_at = None
+        self.completed_at = None
+
+    def arm(self, requests=1, record_shapes=True, profile_memory=True, with_stack=False):
+        with self._lock:
+            if self._active is not None:
+                raise RuntimeError("A trace is being captured, try again when it finishes")
+            self._remaining = requests
+            self._options = {"record_shapes": record_shapes, "profile_memory": profile_memory, "with_stack": with_stack}
+            self._parts = []
+            self.path = None
+            self.armed_at = time.time()
+            self.completed_at = None
+        logger.info(f"Trace capture armed for the next {requests} requests")
+
+    def start_request(self, label):
+        """Start profiling this thread's request if a capture slot is free"""
+        with self._lock:
+            if self._remaining <= 0 or self._active is not None:
+                return False
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            profiler = torch.profiler.profile(activities=activities, **self._options)
+            self._active = profiler
+            self._active_thread = threading.get_ident()
+            self._active_label = label
+            self._remaining -= 1
+        profiler.start()
+        _local.tracing = True
+        return True
+
+    def finish_request(self):
+        """Stop profiling if this thread's request is being captured"""
+        with self._lock:
+            if self._active is None or self._active_thread != threading.get_ident():
+                return
+            profiler, label = self._active, self._active_label
+        _local.tracing = False
+        try:
+            profiler.stop()
+            os.makedirs(self.output_dir, exist_ok=True)
+            part = os.path.join(self.output_dir, f"{self.node_name}-part-{len(self._parts)}.json")
+            profiler.export_chrome_trace(part)
+        finally:
+            with self._lock:
+                self._active = None
+                self._active_thread = None
+        with self._lock:
+            self._parts.append((label, part))
+            if self._remaining == 0:
+                self._merge()
+
+    def _merge(self):
+        events = []
+        for index, (label, part) in enumerate(self._parts, start=1):
+            with open(part) as f:
+                trace = json.load(f)
+            os.remove(part)
+            for event in trace.get("traceEvents", []):
+                if event.get("ph") == "M" and event.get("name") == "process_name":
+                    continue
+                event["pid"] = index
+                events.append(event)
+            events.append({"ph": "M", "name": "process_name", "pid": index, "args": {"name": f"{self.node_name} #{index} {label}"}})
+
+        self.path = os.path.join(self.output_dir, f"{self.node_name}-trace-{int(self.armed_at)}.json")
+        with open(self.path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        self.completed_at = time.time()
+        logger.info(f"Trace of {len(self._parts)} requests written to {self.path}")
+
+    def status(self):
+        with self._lock:
+            if self.path:
+                state = "ready"
+            elif self._remaining > 0 or self._active is not None:
+                state = "capturing"
+            else:
+                state = "idle"
+            return {
+                "state": state,
+                "remaining_requests": self._remaining,
+                "captured_requests": len(self._parts),
+                "options": self._options,
+                "path": self.path,
+            }
+
+
+def create_profiling_blueprint(layer_profiler, trace_capture, traced_endpoints, admin_token=None):
+    """
+    Admin endpoints under /admin/profile and the request hooks that drive trace capture.
+    Only requests to `traced_endpoints` are captured. With `admin_token` set, requests
+    must send it in the X-Admin-Token header.
+    """
+    bp = Blueprint("profiling", __name__)
+
+    @bp.before_request
+    def check_token():
+        if admin_token and not hmac.compare_digest(request.headers.get("X-Admin-Token", ""), admin_token):
+            return jsonify({"status": "error", "message": "Invalid admin token"}), 403
+
+    @bp.before_app_request
+    def start_trace():
+        if request.endpoint in traced_endpoints:
+            trace_capture.start_request(f"{request.method} {request.path}")
+
+    @bp.teardown_app_request
+    def finish_trace(exc):
+        # Runs after a streamed response has been fully sent
+        try:
+            trace_capture.finish_request()
+        except Exception as e:
+            logger.error(f"Failed to save trace: {str(e)}")
+
+    @bp.route('/admin/profile', methods=['GET'])
+    def profile_status():
+        return jsonify({"layers": layer_profiler.stats(), "trace": trace_capture.status()})
+
+    @bp.route('/admin/profile/layers', methods=['POST'])
+    def profile_layers():
+        data = request.get_json(silent=True) or {}
+        if data.get("reset"):
+            layer_profiler.reset()
+        if "enabled" in data:
+            layer_profiler.enable() if data["enabled"] else layer_profiler.disable()
+        return jsonify(layer_profiler.stats())
+
+    @bp.route('/admin/profile/trace', methods=['POST'])
+    def arm_trace():
+        data = request.get_json(silent=True) or {}
+        try:
+            trace_capture.arm(
+                requests=max(1, int(data.get("requests", 1))),
+                record_shapes=bool(data.get("record_shapes", True)),
+                profile_memory=bool(data.get("profile_memory", True)),
+                with_stack=bool(data.get("with_stack", False)),
+            )
+        except RuntimeError as e:
+            return jsonify({"status": "error", "message": str(e)}), 409
+        return jsonify(trace_capture.status())
+
+    @bp.route('/admin/profile/trace', methods=['GET'])
+    def get_trace():
+        status = trace_capture.status()
+        if status["state"] != "ready":
+            return jsonify(status), 202 if status["state"] == "capturing" else 404
+        return send_file(status["path"], mimetype="application/json", as_attachment=True,
+                         download_name=os.path.basename(status["path"]))
+
+    return bp
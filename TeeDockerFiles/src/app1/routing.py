@@ -0,0 +1,341 @@
+import json
+import logging
+import math
+import os
+import threading
+import time
+
+import requests
+
+logger = logging.getLogger('node1.routing')
+
+# Responses that mean the replica never started the work, so another replica can take it
+RETRYABLE_STATUS_CODES = {502, 503}
+
+
+class NoReplicaAvailable(Exception):
+    """Raised when every Node2 replica failed or none is configured; carries a Retry-After hint"""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Replica:
+    """One Node2 endpoint with its load and health state"""
+
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+        self.outstanding = 0
+        self.ewma_latency = None
+        self.healthy = True
+        self.consecutive_failures = 0
+        self.last_error = None
+        self.last_probe = None
+        self.declined_until = 0.0  # time.monotonic() until which it asked not to be sent requests
+
+    def to_dict(self):
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "declined_for_s": round(max(0.0, self.declined_until - time.monotonic()), 1),
+            "outstanding": self.outstanding,
+            "ewma_latency_s": round(self.ewma_latency, 3) if self.ewma_latency is not None else None,
+            "consecutive_failures": self.consecutive_failures,
+            "last_error": self.last_error,
+        }
+
+
+class Lease:
+    """A replica held busy for the lifetime of a streaming response"""
+
+    def __init__(self, pool, replica, response, started):
+        self.pool = pool
+        self.replica = replica
+        self.response = response
+        self.started = started
+        self.released = False
+
+    def release(self, success=True):
+        if self.released:
+            return
+        self.released = True
+        self.response.close()
+        self.pool._finish(self.replica, self.started, success)
+
+
+class PinnedSession:
+    """
+    Requests that share state on one Node2 replica, such as prefill chunks building up a
+    KV cache. The first request picks a replica (with failover); later ones go to the same
+    replica and fail rather than move, since the state would not exist elsewhere.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.replica = None
+
+    def post(self, path, payload, timeout):
+        replica, response = self.pool._post(path, payload, timeout, pinned=self.replica)
+        self.replica = replica
+        return response
+
+    def post_stream(self, path, payload, timeout):
+        lease = self.pool.post_stream(path, payload, timeout, pinned=self.replica)
+        self.replica = lease.replica
+        return lease
+
+
+class Node2Pool:
+    """
+    Pool of Node2 replicas with health probing, load balancing and failover.
+
+    Replicas come from a static list and/or a registry, either a JSON file or an HTTP
+    URL returning `{"replicas": [...]}` or a bare list. The registry is re-read on every
+    probe cycle. Policy "least_outstanding" picks the replica with the fewest in-flight
+    requests (ties broken by latency); "ewma" picks the lowest latency EWMA scaled by
+    load. Failures where the replica never took the request (connection errors, 502/503)
+    are retried on another replica; read timeouts are not, since Node2 may still be working.
+    A replica that declines with 503 and Retry-After is skipped until that time passes.
+    """
+
+    def __init__(self, urls=None, registry=None, policy="least_outstanding",
+                 probe_interval=10.0, probe_timeout=2.0, max_attempts=3, failure_threshold=2, ewma_alpha=0.3):
+        if policy not in ("least_outstanding", "ewma"):
+            raise ValueError(f"Unknown load balancing policy: {policy}")
+        self.static_urls = [u for u in (urls or []) if u]
+        self.registry = registry
+        self.policy = policy
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self.max_attempts = max_attempts
+        self.failure_threshold = failure_threshold
+        self.ewma_alpha = ewma_alpha
+
+        self._lock = threading.Lock()
+        self._replicas = {}
+        self._registry_mtime = None
+        self._registry_urls = []
+        self._stop = threading.Event()
+        self._thread = None
+        self.refresh()
+
+    @classmethod
+    def from_env(cls):
+        """Build a pool from NODE2_URLS / NODE2_URL and NODE2_REGISTRY"""
+        registry = os.environ.get("NODE2_REGISTRY")
+        default_url = "" if registry else "http://app2:5001"
+        urls = os.environ.get("NODE2_URLS") or os.environ.get("NODE2_URL", default_url)
+        return cls(
+            urls=[u.strip() for u in urls.split(",")],
+            registry=registry,
+            policy=os.environ.get("NODE2_LB_POLICY", "least_outstanding"),
+            probe_interval=float(os.environ.get("NODE2_PROBE_INTERVAL", "10")),
+        )
+
+    # Discovery
+
+    def _read_registry(self):
+        if not self.registry:
+            return []
+        if self.registry.startswith(("http://", "https://")):
+            data = requests.get(self.registry, timeout=self.probe_timeout).json()
+        else:
+            mtime = os.path.getmtime(self.registry)
+            if mtime == self._registry_mtime:
+                return None  # Unchanged since the last read
+            with open(self.registry) as f:
+                data = json.load(f)
+            self._registry_mtime = mtime
+        return data.get("replicas", []) if isinstance(data, dict) else data
+
+    def refresh(self):
+        """Reconcile the replica set with the static list and the registry"""
+        try:
+            registry_urls = self._read_registry()
+            if registry_urls is not None:
+                self._registry_urls = list(registry_urls)
+        except Exception as e:
+            # Keep the last known registry contents
+            logger.warning(f"Could not read Node2 registry {self.registry}: {str(e)}")
+
+        wanted = {u.rstrip("/") for u in self.static_urls + self._registry_urls}
+        with self._lock:
+            for url in wanted - set(self._replicas):
+                logger.info(f"Adding Node2 replica {url}")
+                self._replicas[url] = Replica(url)
+            for url in set(self._replicas) - wanted:
+                logger.info(f"Removing Node2 replica {url}")
+                del self._replicas[url]
+
+    # Health probing
+
+    def probe(self):
+        for replica in self.replicas():
+            try:
+                response = requests.get(f"{replica.url}/health", timeout=self.probe_timeout)
+                ok = response.status_code == 200
+                error = None if ok else f"HTTP {response.status_code}"
+            except requests.exceptions.RequestException as e:
+                ok, error = False, str(e)
+            with self._lock:
+                replica.last_probe = time.time()
+                if ok:
+                    if not replica.healthy:
+                        logger.info(f"Node2 replica {replica.url} is healthy again")
+                    replica.healthy = True
+                    replica.consecutive_failures = 0
+                else:
+                    replica.last_error = error
+                    replica.consecutive_failures += 1
+                    if replica.consecutive_failures >= self.failure_threshold and replica.healthy:
+                        logger.warning(f"Node2 replica {replica.url} marked unhealthy: {error}")
+                        replica.healthy = False
+
+    def _probe_loop(self):
+        while not self._stop.wait(self.probe_interval):
+            self.refresh()
+            self.probe()
+
+    def start(self):
+        """Start background discovery and health probing"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._probe_loop, name="node2-probe", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    # Selection
+
+    def replicas(self):
+        with self._lock:
+            return list(self._replicas.values())
+
+    def _score(self, replica):
+        latency = replica.ewma_latency if replica.ewma_latency is not None else 0.0
+        if self.policy == "ewma":
+            return (latency * (replica.outstanding + 1), replica.outstanding)
+        return (replica.outstanding, latency)
+
+    def _acquire(self, exclude, pinned=None):
+        with self._lock:
+            if pinned is not None:
+                if pinned.url in exclude or pinned.url not in self._replicas:
+                    return None
+                pinned.outstanding += 1
+                return pinned
+            now = time.monotonic()
+            candidates = [r for r in self._replicas.values() if r.url not in exclude and r.declined_until <= now]
+            # With every replica marked unhealthy, still try them rather than fail outright
+            healthy = [r for r in candidates if r.healthy] or candidates
+            if not healthy:
+                return None
+            replica = min(healthy, key=self._score)
+            replica.outstanding += 1
+            return replica
+
+    def _retry_after(self):
+        """Seconds until the first declining replica takes requests again, if any declined"""
+        now = time.monotonic()
+        with self._lock:
+            waits = [r.declined_until - now for r in self._replicas.values() if r.declined_until > now]
+        return max(1, math.ceil(min(waits))) if waits else None
+
+    def _finish(self, replica, started, success, error=None, retry_after=None):
+        """
+        Record a request's outcome; success=None means the replica declined it but is
+        healthy, and is not sent new requests for `retry_after` seconds
+        """
+        with self._lock:
+            replica.outstanding -= 1
+            if success is None:
+                replica.last_error = error
+                replica.declined_until = time.monotonic() + retry_after
+            elif success:
+                latency = time.monotonic() - started
+                if replica.ewma_latency is None:
+                    replica.ewma_latency = latency
+                else:
+                    replica.ewma_latency += self.ewma_alpha * (latency - replica.ewma_latency)
+                replica.consecutive_failures = 0
+                replica.healthy = True
+            else:
+                replica.last_error = error
+                replica.consecutive_failures += 1
+                if replica.consecutive_failures >= self.failure_threshold:
+                    replica.healthy = False
+
+    # Requests
+
+    def _send(self, path, payload, timeout, stream, pinned=None):
+        tried = set()
+        last_error = None
+        for _ in range(self.max_attempts):
+            replica = self._acquire(tried, pinned)
+            if replica is None:
+                break
+            tried.add(replica.url)
+            started = time.monotonic()
+            try:
+                response = requests.post(f"{replica.url}{path}", json=payload, timeout=timeout, stream=stream)
+            except (requests.exceptions.ConnectionError, requests.exceptions.ConnectTimeout) as e:
+                last_error = str(e)
+                self._finish(replica, started, False, last_error)
+                logger.warning(f"Node2 replica {replica.url} unreachable, trying another: {last_error}")
+                continue
+            except Exception as e:
+                self._finish(replica, started, False, str(e))
+                raise
+
+            if response.status_code in RETRYABLE_STATUS_CODES:
+                last_error = f"HTTP {response.status_code}"
+                # A 503 with Retry-After comes from a live replica that cannot take the request
+                # yet (e.g. it is still loading the model), so it does not count as a failure
+                retry_after = response.headers.get("Retry-After") if response.status_code == 503 else None
+                response.close()
+                if retry_after is None:
+                    self._finish(replica, started, False, last_error)
+                else:
+                    try:
+                        retry_after = float(retry_after)
+                    except ValueError:  # An HTTP date; wait for the next probe cycle instead
+                        retry_after = self.probe_interval
+                    self._finish(replica, started, None, last_error, retry_after)
+                logger.warning(f"Node2 replica {replica.url} returned {last_error}, trying another")
+                continue
+
+            return replica, response, started
+
+        retry_after = self._retry_after()
+        if last_error is None:
+            last_error = "every replica asked to retry later" if retry_after else "none configured"
+        raise NoReplicaAvailable(f"No Node2 replica could take the request: {last_error}", retry_after)
+
+    def _post(self, path, payload, timeout, pinned=None):
+        replica, response, started = self._send(path, payload, timeout, stream=False, pinned=pinned)
+        # A 504 is the request's own deadline expiring, not a sign of an unhealthy replica
+        success = response.status_code < 500 or response.status_code == 504
+        self._finish(replica, started, success, f"HTTP {response.status_code}")
+        return replica, response
+
+    def post(self, path, payload, timeout):
+        """POST to the best replica with failover and return the completed response"""
+        return self._post(path, payload, timeout)[1]
+
+    def post_stream(self, path, payload, timeout, pinned=None):
+        """POST a streaming request; the returned Lease must be released when the stream ends"""
+        replica, response, started = self._send(path, payload, timeout, stream=True, pinned=pinned)
+        return Lease(self, replica, response, started)
+
+    def session(self):
+        """Start a sequence of requests that must all reach the same replica"""
+        return PinnedSession(self)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "policy": self.policy,
+                "registry": self.registry,
+                "replicas": [r.to_dict() for r in self._replicas.values()],
+            }
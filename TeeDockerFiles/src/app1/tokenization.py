@@ -0,0 +1,212 @@
+import logging
+import math
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger('node1.tokenization')
+
+# Placeholder rendered into the chat template to locate the user content
+CONTENT_SENTINEL = "\x00TEETEE_CONTENT\x00"
+
+# Prompts used to check that the fast path produces exactly the slow path's ids
+PROBE_PROMPTS = [
+    "Hello",
+    "What is 2+2?",
+    " leading and trailing spaces ",
+    "multi\nline\n\ntext",
+    "\nleading newline",
+    "unicode: 日本語 😀 café",
+    "a",
+    "",
+]
+
+
+class LRUCache:
+    """Small thread-safe LRU map"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return None
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def info(self):
+        with self._lock:
+            return {"size": len(self._data), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
+
+
+class ChatTokenizer:
+    """
+    Tokenize single-turn user prompts without re-rendering the chat template.
+
+    The template is rendered once around a sentinel to split it into fixed prefix and
+    suffix segments whose token ids are cached. Each request then only tokenizes the user
+    content (memoized in an LRU) and concatenates the ids.
+
+    This is only exact when the content is delimited by special/added tokens: those are
+    split out before BPE runs, so no merge can cross into the content. Otherwise a merge
+    spanning the template text and the content can make the ids differ, which no set of
+    probe prompts rules out. With mode "exact" the fast path is therefore only used at
+    special-token boundaries; mode "probe" also uses it when it matches
+    `apply_chat_template` + `encode` on the probe prompts, accepting that risk. Either
+    way the probes must pass; otherwise every call falls back to the original slow path.
+    """
+
+    def __init__(self, tokenizer, cache_size=1024, max_workers=4, mode="exact"):
+        if mode not in ("exact", "probe"):
+            raise ValueError(f"Unknown tokenizer fast path mode: {mode}")
+        self.tokenizer = tokenizer
+        self.max_workers = max_workers
+        self.mode = mode
+        self.exact_boundaries = False
+        self.prefix_ids = None
+        self.suffix_ids = None
+        self.anchor_ids = None
+        self.anchor = None
+        self.fast_path = False
+        self._executor = None
+        self._content_cache = LRUCache(cache_size)
+        self._compile()
+
+    def _compile(self):
+        """Split the rendered template into cached segments and pick a content encoding"""
+        try:
+            rendered = self.tokenizer.apply_chat_template(
+                [{"role": "user", "content": CONTENT_SENTINEL}], tokenize=False, add_generation_prompt=True
+            )
+        except Exception as e:
+            logger.warning(f"Could not render chat template, using slow tokenization path: {str(e)}")
+            return
+
+        if rendered.count(CONTENT_SENTINEL) != 1:
+            logger.warning("Chat template does not embed the content verbatim, using slow tokenization path")
+            return
+
+        prefix, suffix = rendered.split(CONTENT_SENTINEL)
+        self.prefix_ids = tuple(self.tokenizer.encode(prefix))
+        self.suffix_ids = tuple(self.tokenizer.encode(suffix, add_special_tokens=False))
+
+        added_ids = set(self.tokenizer.all_special_ids) | set(self.tokenizer.get_added_vocab().values())
+        self.exact_boundaries = (
+            self.prefix_ids[-1:] != () and self.prefix_ids[-1] in added_ids
+            and (not suffix or self.suffix_ids[:1] != () and self.suffix_ids[0] in added_ids)
+        )
+        if not self.exact_boundaries and self.mode == "exact":
+            logger.info("Chat template content is not delimited by special tokens, using slow tokenization path")
+            return
+
+        # SentencePiece tokenizers add a word-boundary marker at the start of a string, so
+        # content may need to be encoded behind the character that precedes it in the template
+        for anchor in ("", prefix[-1:]):
+            self.anchor = anchor
+            self.anchor_ids = tuple(self.tokenizer.encode(anchor, add_special_tokens=False)) if anchor else ()
+            self._content_cache.clear()
+            if all(self._fast_encode(p) == self.encode_slow(p) for p in PROBE_PROMPTS):
+                self.fast_path = True
+                logger.info(
+                    f"Chat template compiled: {len(self.prefix_ids)} prefix and "
+                    f"{len(self.suffix_ids)} suffix tokens cached (anchor={anchor!r}, "
+                    f"exact_boundaries={self.exact_boundaries})"
+                )
+                return
+
+        self._content_cache.clear()
+        logger.warning("Fast tokenization did not match the chat template output, using slow tokenization path")
+
+    def _strip_anchor(self, ids):
+        if self.anchor_ids and tuple(ids[:len(self.anchor_ids)]) == self.anchor_ids:
+            ids = ids[len(self.anchor_ids):]
+        return tuple(ids)
+
+    def _encode_content(self, content):
+        ids = self._content_cache.get(content)
+        if ids is None:
+            ids = self._strip_anchor(self.tokenizer.encode(self.anchor + content, add_special_tokens=False))
+            self._content_cache.put(content, ids)
+        return ids
+
+    def _fast_encode(self, content):
+        return list(self.prefix_ids + self._encode_content(content) + self.suffix_ids)
+
+    def encode_slow(self, content):
+        """Original path: render the template to a string, then tokenize it"""
+        # The assistant header is part of the prompt so the model starts with the reply itself
+        chat_prompt = self.tokenizer.apply_chat_template(
+            [{"role": "user", "content": content}], tokenize=False, add_generation_prompt=True
+        )
+        return self.tokenizer.encode(chat_prompt)
+
+    def encode(self, content):
+        """Return the chat-formatted token ids for one user prompt"""
+        if not self.fast_path:
+            return self.encode_slow(content)
+        return self._fast_encode(content)
+
+    def encode_batch(self, contents):
+        """
+        Tokenize many prompts, splitting uncached contents across a thread pool.
+        The Rust fast tokenizer releases the GIL, so the chunks run in parallel.
+        """
+        if not self.fast_path:
+            return [self.encode_slow(c) for c in contents]
+
+        missing = list(dict.fromkeys(c for c in contents if c not in self._content_cache))
+        if missing:
+            for content, ids in zip(missing, self._tokenize_many(missing)):
+                self._content_cache.put(content, ids)
+
+        return [self._fast_encode(c) for c in contents]
+
+    def _tokenize_many(self, contents):
+        texts = [self.anchor + c for c in contents]
+        if not getattr(self.tokenizer, "is_fast", False) or len(texts) < 2 * self.max_workers:
+            batches = [self._tokenize_chunk(texts)]
+        else:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="tokenize")
+            chunk_size = math.ceil(len(texts) / self.max_workers)
+            chunks = [texts[i:i + chunk_size] for i in range(0, len(texts), chunk_size)]
+            batches = list(self._executor.map(self._tokenize_chunk, chunks))
+
+        return [self._strip_anchor(ids) for batch in batches for ids in batch]
+
+    def _tokenize_chunk(self, texts):
+        return self.tokenizer(texts, add_special_tokens=False)["input_ids"]
+
+    def cache_info(self):
+        return self._content_cache.info()
+
+    def stats(self):
+        return {
+            "fast_path": self.fast_path,
+            "mode": self.mode,
+            "exact_boundaries": self.exact_boundaries,
+            "cache": self.cache_info(),
+        }
@@ -1,6 +1,6 @@
 import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM
-from flask import Flask, request, jsonify
+from transformers import AutoConfig, AutoTokenizer, AutoModelForCausalLM
+from flask import Flask, Response, request, jsonify, stream_with_context
 import logging
 import time
 import traceback
@@ -14,7 +14,17 @@ import shutil
 import subprocess
 import sys
 import gdown
-from transformers.modeling_outputs import BaseModelOutputWithPast, CausalLMOutputWithPast
+import threading
+from transformers import DynamicCache
+from scheduling import StepScheduler
+from cpu_tuning import CpuTuner
+from compilation import ShardCompiler
+from weight_store import load_shard_model
+from node2_model import GenerationCancelled, Node2Model, make_layer_benchmark
+from detokenization import IncrementalDetokenizer
+from attestation import AttestationAggregator, sha256_hex
+from model_registry import HostedModel, ModelLoading, ModelRegistry, ModelSpec, ModelUnavailable, UnknownModel
+from profiling import LayerProfiler, TraceCapture, create_profiling_blueprint, region
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -25,11 +35,14 @@ os.environ["HUGGINGFACE_HUB_DOWNLOAD_TIMEOUT"] = "1800"  # 30 minutes
 
 app = Flask(__name__)
 
+# CPU binding and inter-op pool size must be set before any parallel work starts
+cpu_tuner = CpuTuner.from_env()
+
 # For storing the model verification hash
 model_hash = None
 model_info = {}
 
-def generate_model_hash(model):
+def generate_model_hash(model, model_name="TinyLlama-1.1B-Chat-v1.0"):
     """Generate a SHA-256 hash of model parameters and architecture"""
     logger.info("Generating model verification hash...")
     
@@ -53,7 +66,7 @@ def generate_model_hash(model):
     hash_data = {
         "architecture": model_arch,
         "parameters_sample": param_sample,
-        "model_name": "TinyLlama-1.1B-Chat-v1.0",
+        "model_name": model_name,
         "total_layers": len(model.model.layers),
         "node": "2"
     }
@@ -64,11 +77,10 @@ def generate_model_hash(model):
     
     return hash_result, hash_data
 
-def download_model_from_gdrive():
+def download_model_from_gdrive(model_dir="/app/models/tinyllama-1b", folder_id="1Iua1_n95NSgndooGFPfppaKTti5mmtEy"):
     """Download model files from Google Drive"""
     logger.info("Downloading model files from Google Drive")
     
-    model_dir = "/app/models/tinyllama-1b"
     os.makedirs(model_dir, exist_ok=True)
     
     try:
@@ -82,7 +94,7 @@ def download_model_from_gdrive():
     try:
         logger.info(f"Downloading entire model folder from Google Drive...")
         gdown.download_folder(
-            id="1Iua1_n95NSgndooGFPfppaKTti5mmtEy",
+            id=folder_id,
             output=model_dir,
             quiet=False
         )
@@ -93,142 +105,13 @@ def download_model_from_gdrive():
     
     return success
 
-# Create a custom class for Node2 model that starts from the middle layer
-class Node2Model(torch.nn.Module):
-    def __init__(self, base_model, middle_layer):
-        super().__init__()
-        self.config = base_model.config
-        self.embed_tokens = base_model.model.embed_tokens  # Needed for vocab projections
-        self.norm = base_model.model.norm
-        self.lm_head = base_model.lm_head
-        
-        # Only include the second half of layers
-        self.layers = base_model.model.layers[middle_layer:]
-        
-        logger.info(f"Node2 initialized with layers {middle_layer} to {len(base_model.model.layers)-1}")
-
-    def forward(self, hidden_states, attention_mask=None, position_ids=None, output_hidden_states=True):
-        # Store all hidden states if requested
-        all_hidden_states = () if output_hidden_states else None
-        
-        # Process through the second half of layers
-        for idx, layer in enumerate(self.layers):
-            if output_hidden_states:
-                all_hidden_states = all_hidden_states + (hidden_states,)
-                
-            # Process through this layer
-            hidden_states = layer(hidden_states, attention_mask)[0]
-            
-        # Apply final normalization
-        hidden_states = self.norm(hidden_states)
-        
-        # Get logits from the final hidden states
-        logits = self.lm_head(hidden_states)
-        
-        # Return the output and the hidden_states
-        return CausalLMOutputWithPast(
-            logits=logits,
-            past_key_values=None,
-            hidden_states=all_hidden_states,
-            attentions=None
-        )
+def load_node2_model(spec):
+    """Load the tokenizer and the second half of the layers (with lm_head) of a registry model"""
+    model_name = spec.path
+    if spec.gdrive_id and not os.path.exists(os.path.join(model_name, "config.json")):
+        if not download_model_from_gdrive(model_name, spec.gdrive_id):
+            logger.error("Failed to download model files. Trying to use local files if available.")
     
-    def generate(self, hidden_states, input_ids, attention_mask=None, position_ids=None, 
-                max_new_tokens=128, temperature=0.7, top_p=0.9):
-        """
-        Generate text by continuing from the provided hidden states
-        """
-        batch_size = hidden_states.shape[0]
-        device = hidden_states.device
-        
-        # Start with initial hidden states and input_ids from Node1
-        current_hidden_states = hidden_states
-        current_input_ids = input_ids
-        all_input_ids = input_ids.clone()
-        
-        # Keep track of attention_mask and position_ids
-        if attention_mask is None:
-            attention_mask = torch.ones_like(input_ids, device=device)
-        else:
-            attention_mask = attention_mask.to(device)
-            
-        if position_ids is None:
-            position_ids = torch.arange(input_ids.shape[1], device=device).unsqueeze(0)
-        else:
-            position_ids = position_ids.to(device)
-            
-        # Start generation loop
-        for i in range(max_new_tokens):
-            with torch.no_grad():
-                # Process current hidden states through our layers
-                outputs = self.forward(
-                    current_hidden_states, 
-                    attention_mask=attention_mask,
-                    position_ids=position_ids,
-                    output_hidden_states=False
-                )
-                
-                # Get next token logits from the last position
-                next_token_logits = outputs.logits[:, -1, :]
-                
-                # Apply temperature
-                next_token_logits = next_token_logits / temperature
-                
-                # Apply top-p sampling
-                sorted_logits, sorted_indices = torch.sort(next_token_logits, descending=True)
-                cumulative_probs = torch.cumsum(torch.softmax(sorted_logits, dim=-1), dim=-1)
-                
-                # Remove tokens with cumulative probability above the threshold
-                sorted_indices_to_remove = cumulative_probs > top_p
-                # Shift the indices to the right to keep the first token above threshold
-                sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[..., :-1].clone()
-                sorted_indices_to_remove[..., 0] = 0
-                
-                for batch_idx in range(batch_size):
-                    indices_to_remove = sorted_indices[batch_idx][sorted_indices_to_remove[batch_idx]]
-                    next_token_logits[batch_idx, indices_to_remove] = -float("Inf")
-                
-                # Sample from the filtered distribution
-                probs = torch.softmax(next_token_logits, dim=-1)
-                next_token = torch.multinomial(probs, num_samples=1)
-                
-                # Append to the sequence
-                all_input_ids = torch.cat([all_input_ids, next_token], dim=-1)
-                
-                # Check if we've hit the end of sequence token
-                if next_token[0, 0].item() == self.config.eos_token_id:
-                    break
-                
-                # Prepare for the next iteration
-                # Expand attention_mask and position_ids
-                attention_mask = torch.cat([
-                    attention_mask, 
-                    torch.ones((batch_size, 1), device=device)
-                ], dim=-1)
-                
-                position_ids = torch.cat([
-                    position_ids, 
-                    (position_ids[0, -1] + 1).unsqueeze(0).unsqueeze(0)
-                ], dim=-1)
-                
-                # Embed the new token to create the next hidden state
-                token_embeds = self.embed_tokens(next_token)
-                
-                # Process this token through all layers 
-                current_hidden_states = token_embeds
-                
-        
-        return all_input_ids
-
-# Initialize tokenizer and model from local directory
-logger.info("Initializing Node2 (second half of model)...")
-model_name = "/app/models/tinyllama-1b"  # Local path in container
-
-# Try to download model files first
-if not download_model_from_gdrive():
-    logger.error("Failed to download model files. Trying to use local files if available.")
-
-try:
     logger.info("Loading tokenizer from local directory...")
     tokenizer = AutoTokenizer.from_pretrained(model_name, local_files_only=True)
     logger.info("Tokenizer loaded successfully")
@@ -238,14 +121,31 @@ try:
     if torch.cuda.is_available():
         torch.cuda.empty_cache()
     
-    logger.info("Loading model from local directory...")
-    full_model = AutoModelForCausalLM.from_pretrained(
-        model_name,
-        torch_dtype=torch.float16,
-        device_map="cpu",  # Initial CPU loading
-        low_cpu_mem_usage=True,
-        local_files_only=True
-    )
+    weight_store_dir = os.environ.get("WEIGHT_STORE_DIR")
+    if weight_store_dir:
+        # Map this node's weights read-only from a pre-converted file shared through the page cache
+        num_layers = AutoConfig.from_pretrained(model_name, local_files_only=True).num_hidden_layers
+        store_path = os.path.join(weight_store_dir, f"{os.path.basename(model_name)}-fp16.safetensors")
+        logger.info(f"Loading model from weight store {store_path}...")
+        full_model = load_shard_model(
+            model_name,
+            store_path,
+            layer_range=(num_layers // 2, num_layers),
+            include_lm_head=True,
+            torch_dtype=torch.float16,
+            local_files_only=True,
+            attn_implementation="sdpa"
+        )
+    else:
+        logger.info("Loading model from local directory...")
+        full_model = AutoModelForCausalLM.from_pretrained(
+            model_name,
+            torch_dtype=torch.float16,
+            device_map="cpu",  # Initial CPU loading
+            low_cpu_mem_usage=True,
+            local_files_only=True,
+            attn_implementation="sdpa"  # Fused scaled-dot-product attention on CPU and GPU
+        )
     logger.info("Model loaded successfully")
     
     # Get the total layers and mid point
@@ -257,7 +157,7 @@ try:
     model = Node2Model(full_model, middle_layer)
     
     # Generate and store model hash
-    model_hash, model_info = generate_model_hash(full_model)
+    model_hash, model_info = generate_model_hash(full_model, spec.display_name)
     logger.info(f"Model verification hash: {model_hash}")
     
     # Release memory from the full model
@@ -270,23 +170,63 @@ try:
         memory_allocated = torch.cuda.memory_allocated() / (1024 ** 3)
         logger.info(f"Model moved to GPU. Memory used: {memory_allocated:.2f} GB")
     
+    return HostedModel(spec, model, model_hash, model_info, tokenizer=tokenizer)
+
+# Initialize tokenizer and model from local directory
+logger.info("Initializing Node2 (second half of model)...")
+default_spec = ModelSpec(
+    os.environ.get("DEFAULT_MODEL_ID", "tinyllama-1.1b-chat"),
+    "/app/models/tinyllama-1b",  # Local path in container
+    gdrive_id="1Iua1_n95NSgndooGFPfppaKTti5mmtEy",
+    display_name="TinyLlama-1.1B-Chat-v1.0"
+)
+
+# Try to download model files first
+if not download_model_from_gdrive(default_spec.path, default_spec.gdrive_id):
+    logger.error("Failed to download model files. Trying to use local files if available.")
+
+try:
+    default_model = load_node2_model(default_spec)
+    # Further models from MODEL_REGISTRY are loaded on first use and evicted under MODEL_MEMORY_BUDGET_GB
+    models = ModelRegistry.from_env(load_node2_model, "node2", default_model)
 except Exception as e:
     logger.error(f"Error loading model: {str(e)}")
     logger.error(traceback.format_exc())
     raise  # This will cause the container to exit on model load failure
 
+# The default model is the one compiled, tuned and profiled below
+model = default_model.model
+tokenizer = default_model.tokenizer
+model_hash = default_model.model_hash
+model_info = default_model.model_info
+middle_layer = model.middle_layer
+
+# Optional compiled graphs for norms and MLPs (COMPILE_MODE=inductor), before tuning so
+# the thread search times the path that serves requests
+shard_compiler = ShardCompiler.from_env()
+shard_compiler.compile(
+    model.layers, model_hash, model.config.hidden_size,
+    dtype=model.layers[0].parameters().__next__().dtype, device=model.layers[0].parameters().__next__().device,
+    extra=[model.norm]
+)
+
+# Keep the thread count (and CPU set) that runs a decoder layer fastest on this host;
+# Node2 mostly runs single-token decode steps
+cpu_tuner.autotune(make_layer_benchmark(model.layers[0], model.rotary_emb, model.config, [(1, 16), (64, 1)]))
+
 # Generation parameters
 max_new_tokens = 128
 temperature = 0.7
 top_p = 0.9
 
-def get_ra_data(custom_data):
+def get_ra_data(custom_data, hash_algorithm="sha256"):
     """
     Call the Node script with custom data and return the RA report.
+    With hash_algorithm="raw", custom_data is hex used as the report data as is.
     """
     try:
         result = subprocess.run(
-            ["node", "generate_ra.js", custom_data],
+            ["node", "generate_ra.js", custom_data, hash_algorithm],
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
             check=True,
@@ -299,9 +239,163 @@ def get_ra_data(custom_data):
     except json.JSONDecodeError as je:
         return {"error": "Invalid JSON returned from Node script", "details": str(je)}
 
+class PrefillSession:
+    """KV cache built up from prefill chunks that Node1 streams ahead of /generate"""
+
+    def __init__(self, session_id, expires_at):
+        self.session_id = session_id
+        self.expires_at = expires_at
+        self.cache = DynamicCache()
+        self.next_chunk = 0
+        self.length = 0
+
+class PrefillSessions:
+    """Open prefill sessions by id; sessions past their deadline are dropped"""
+
+    def __init__(self, default_ttl=300):
+        self.default_ttl = default_ttl
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def _purge(self):
+        now = time.monotonic()
+        for session_id in [k for k, v in self._sessions.items() if v.expires_at <= now]:
+            logger.warning(f"Dropping expired prefill session {session_id}")
+            del self._sessions[session_id]
+
+    def get(self, session_id, chunk_index, ttl=None):
+        with self._lock:
+            self._purge()
+            if chunk_index == 0 and session_id not in self._sessions:
+                expires_at = time.monotonic() + (ttl if ttl is not None else self.default_ttl)
+                self._sessions[session_id] = PrefillSession(session_id, expires_at)
+            return self._sessions.get(session_id)
+
+    def pop(self, session_id):
+        with self._lock:
+            self._purge()
+            return self._sessions.pop(session_id, None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
+
+# Model steps from all requests take turns; prefill chunks wait for their own session
+step_scheduler = StepScheduler()
+prefill_sessions = PrefillSessions()
+
+# Requests attested within the window share one quote over a Merkle root of their records
+ATTESTATION_TIMEOUT = float(os.environ.get("ATTESTATION_TIMEOUT", "30"))
+attestations = AttestationAggregator(
+    get_ra_data,
+    window=float(os.environ.get("ATTESTATION_BATCH_WINDOW_MS", "200")) / 1000,
+    max_batch=int(os.environ.get("ATTESTATION_MAX_BATCH", "1024"))
+)
+
+# Opt-in profiling: per-layer forward hooks and torch.profiler traces under /admin/profile
+if os.environ.get("ENABLE_PROFILING", "0") == "1":
+    layer_profiler = LayerProfiler.for_layers(
+        model.layers, first_index=middle_layer, extra={"norm": model.norm, "lm_head": model.lm_head}
+    )
+    trace_capture = TraceCapture(os.environ.get("PROFILE_DIR", "/tmp/profiles"), "node2")
+    app.register_blueprint(create_profiling_blueprint(
+        layer_profiler, trace_capture, {"generate", "prefill"}, admin_token=os.environ.get("ADMIN_TOKEN")
+    ))
+    if os.environ.get("PROFILE_LAYERS", "0") == "1":
+        layer_profiler.enable()
+
+@app.route('/prefill', methods=['POST'])
+def prefill():
+    """Run one prefill chunk from Node1 through our layers, extending the session's KV cache"""
+    hosted = None
+    try:
+        data = request.get_json()
+        session_id = data["session_id"]
+        chunk_index = int(data["chunk_index"])
+        ttl = data["deadline_ms"] / 1000 if "deadline_ms" in data else None
+        
+        session = prefill_sessions.get(session_id, chunk_index, ttl)
+        if session is None:
+            return jsonify({"status": "error", "message": f"Unknown or expired prefill session {session_id}"}), 404
+        if chunk_index != session.next_chunk:
+            return jsonify({
+                "status": "error",
+                "message": f"Expected chunk {session.next_chunk}, got {chunk_index}"
+            }), 409
+        
+        # The cache only holds tensors, so a model evicted and reloaded between chunks continues it
+        hosted = models.acquire(data.get("model"))
+        device = hosted.model.layers[0].parameters().__next__().device
+        hidden_states = torch.tensor(data["hidden_states"], dtype=torch.float16).to(device)
+        chunk_length = hidden_states.shape[1]
+        position_ids = torch.arange(session.length, session.length + chunk_length, device=device).unsqueeze(0)
+        
+        with step_scheduler.step(), torch.no_grad():
+            hosted.model(
+                hidden_states,
+                position_ids=position_ids,
+                past_key_values=session.cache,
+                output_hidden_states=False,
+                last_logits_only=True
+            )
+        
+        session.next_chunk += 1
+        session.length += chunk_length
+        logger.info(f"Prefill session {session_id}: chunk {chunk_index} done, {session.length} tokens cached")
+        return jsonify({"status": "ok", "session_id": session_id, "prefilled_tokens": session.length})
+    
+    except UnknownModel as e:
+        return jsonify({"status": "error", "message": str(e)}), 404
+    except ModelLoading as e:
+        logger.info(str(e))
+        return jsonify({"status": "loading", "message": str(e)}), 503, {"Retry-After": str(e.retry_after)}
+    except ModelUnavailable as e:
+        logger.error(f"Model unavailable: {str(e)}")
+        return jsonify({"status": "error", "message": str(e)}), 503
+    except Exception as e:
+        logger.error(f"Error in prefill: {str(e)}")
+        logger.error(traceback.format_exc())
+        return jsonify({"status": "error", "message": f"Error in prefill: {str(e)}"}), 500
+    finally:
+        if hosted is not None:
+            models.release(hosted)
+
+def build_generation_result(hosted, response_text, prompt, activations_hash, input_positions, mid_layer, hidden_states_shape, generation_time):
+    """Attest the finished generation and build the response body"""
+    # The record joins a batch that shares one quote; the response carries its inclusion proof
+    logger.info("Generating remote attestation data...")
+    try:
+        ra_data = attestations.attest({
+            "node": "node2",
+            "model": hosted.model_id,
+            "model_hash": hosted.model_hash,
+            "layers": f"{mid_layer}-{mid_layer+len(hosted.model.layers)-1}",
+            "prompt_hash": sha256_hex(prompt),
+            "input_hash": activations_hash,
+            # With a chunked prefill only the final chunk's activations are hashed
+            "input_positions": list(input_positions),
+            "input_shape": list(hidden_states_shape),
+            "output_hash": sha256_hex(response_text),
+            "timestamp": time.time()
+        }, timeout=ATTESTATION_TIMEOUT)
+    except Exception as e:
+        ra_data = {"error": "Error generating RA report", "details": str(e) or type(e).__name__}
+    
+    # Return both the response and RA data
+    return {
+        "output": response_text,
+        "attestation": ra_data,
+        "layer_split_info": {
+            "node1_layers": f"0-{mid_layer-1}",
+            "node2_layers": f"{mid_layer}-{mid_layer+len(hosted.model.layers)-1}",
+            "generation_time_ms": int(generation_time * 1000)
+        }
+    }
+
 @app.route('/generate', methods=['POST'])
 def generate():
     """Generate completion based on the hidden states from node1"""
+    hosted = None
     try:
         # Get data from request
         data = request.get_json()
@@ -310,99 +404,158 @@ def generate():
         layer_info = data.get("layer_info", {})
         mid_layer = layer_info.get("middle_layer", 0)
         
-        # Get the hidden states from Node1
-        hidden_states = torch.tensor(data.get("hidden_states", []), dtype=torch.float16)
-        input_ids = torch.tensor(data.get("input_ids", []), dtype=torch.long)
-        attention_mask = torch.tensor(data.get("attention_mask", []), dtype=torch.long)
-        position_ids = torch.tensor(data.get("position_ids", []), dtype=torch.long)
+        # The model Node1 ran the first half of, held until generation ends so it is not evicted
+        hosted = models.acquire(data.get("model"))
+        
+        # Get the hidden states from Node1; the prompt tokens themselves are not needed
+        device = hosted.model.layers[0].parameters().__next__().device
+        with region("node2.deserialize"):
+            hidden_states = torch.tensor(data.get("hidden_states", []), dtype=torch.float16)
+            # Same digest Node1 attests for the activations it sent
+            activations_hash = sha256_hex(hidden_states.numpy().tobytes())
+        hidden_states = hidden_states.to(device)
+        attention_mask = torch.tensor(data.get("attention_mask", []), dtype=torch.long).to(device)
+        position_ids = torch.tensor(data.get("position_ids", []), dtype=torch.long).to(device)
+        prompt_length = data.get("prompt_length", hidden_states.shape[1])
         prompt = data.get("prompt", "")
         
+        # Continue from the KV cache of earlier prefill chunks, if Node1 sent the prompt in chunks
+        past_key_values = None
+        if "session_id" in data:
+            session = prefill_sessions.pop(data["session_id"])
+            if session is None:
+                return jsonify({"output": f"Error: unknown or expired prefill session {data['session_id']}"}), 404
+            past_key_values = session.cache
+        
+        # Per-request limits from Node1, never above this node's own settings
+        request_max_new_tokens = max(1, min(int(data.get("max_new_tokens", max_new_tokens)), max_new_tokens))
+        deadline = time.monotonic() + data["deadline_ms"] / 1000 if "deadline_ms" in data else None
+        
         logger.info(f"Original prompt: {prompt[:50]}..." if len(prompt) > 50 else f"Original prompt: {prompt}")
-        logger.info(f"Hidden states shape: {hidden_states.shape}")
+        logger.info(f"Hidden states shape: {hidden_states.shape}, prompt length: {prompt_length}")
         logger.info(f"Continuing from layer: {mid_layer}")
         
-        # Move tensors to the same device as the model
-        hidden_states = hidden_states.to(model.layers[0].parameters().__next__().device)
-        input_ids = input_ids.to(model.layers[0].parameters().__next__().device)
-        attention_mask = attention_mask.to(model.layers[0].parameters().__next__().device)
-        position_ids = position_ids.to(model.layers[0].parameters().__next__().device)
-        
+        hidden_states_shape = (hidden_states.shape[0], prompt_length, hidden_states.shape[2])
+        input_positions = (prompt_length - hidden_states.shape[1], prompt_length)
         logger.info("Starting generation...")
         start_time = time.time()
         
-        # Generate response using the provided hidden states
-        with torch.no_grad():
-            generated_ids = model.generate(
-                hidden_states=hidden_states,
-                input_ids=input_ids,
-                attention_mask=attention_mask,
-                position_ids=position_ids,
-                max_new_tokens=max_new_tokens,
-                temperature=temperature,
-                top_p=top_p
-            )
+        # Only newly generated tokens are detokenized, one step at a time
+        detokenizer = IncrementalDetokenizer(hosted.tokenizer)
+        token_stream = hosted.model.stream_generate(
+            hidden_states=hidden_states,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            max_new_tokens=request_max_new_tokens,
+            temperature=temperature,
+            top_p=top_p,
+            deadline=deadline,
+            past_key_values=past_key_values,
+            step_guard=step_scheduler.step
+        )
+        del hidden_states, attention_mask, position_ids, past_key_values
         
-        # Decode the generated tokens
-        generated_text = tokenizer.decode(generated_ids[0], skip_special_tokens=True)
+        if data.get("stream", False):
+            streamed_model = hosted
+            
+            def stream_output():
+                # One JSON object per line: text deltas, then the attested final result
+                started = False
+                try:
+                    with torch.no_grad():
+                        for delta in detokenizer.stream(token_stream):
+                            if not started:
+                                delta = delta.lstrip()
+                                started = bool(delta)
+                            if delta:
+                                yield json.dumps({"token": delta}) + "\n"
+                except GenerationCancelled as e:
+                    logger.warning(f"Streamed generation cancelled: {str(e)}")
+                    yield json.dumps({"output": detokenizer.text.strip(), "status": "timeout", "error": str(e)}) + "\n"
+                    return
+                generation_time = time.time() - start_time
+                logger.info(f"Streamed generation completed in {generation_time:.2f}s")
+                result = build_generation_result(
+                    streamed_model, detokenizer.text.strip(), prompt, activations_hash, input_positions, mid_layer, hidden_states_shape, generation_time
+                )
+                yield json.dumps(result) + "\n"
+            
+            response = Response(stream_with_context(stream_output()), mimetype="application/x-ndjson")
+            # The model is held until the client has received the whole stream
+            response.call_on_close(lambda: models.release(streamed_model))
+            hosted = None
+            return response
         
-        # Extract just the assistant's response by removing the prompt
-        response_text = generated_text.split("assistant")[-1].strip()
+        # Generate response using the provided hidden states
+        with torch.no_grad():
+            for _ in detokenizer.stream(token_stream):
+                pass
+        response_text = detokenizer.text.strip()
         
         # Clean up memory
-        del hidden_states, input_ids, attention_mask, position_ids, generated_ids
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
         
         generation_time = time.time() - start_time
         logger.info(f"Generation completed in {generation_time:.2f}s")
-        logger.info(f"Generated {len(response_text)} characters")
+        logger.info(f"Generated {len(detokenizer.token_ids)} tokens, {len(response_text)} characters")
         
-        # Generate RA data with detailed information about the layer splitting
-        logger.info("Generating remote attestation data...")
-        ra_custom_data = (
-            f"node2_layer_split:continuing_from_layer={mid_layer},"
-            f"layers_used={mid_layer}-{mid_layer+len(model.layers)-1},"
-            f"hidden_state_shape={hidden_states.shape if 'hidden_states' in locals() else 'freed'},"
-            f"output_preview={response_text[:50]}...,time:{time.time()}"
-        )
-        ra_data = get_ra_data(ra_custom_data)
-        
-        # Return both the response and RA data
-        return jsonify({
-            "output": response_text,
-            "attestation": ra_data,
-            "layer_split_info": {
-                "node1_layers": f"0-{mid_layer-1}",
-                "node2_layers": f"{mid_layer}-{mid_layer+len(model.layers)-1}",
-                "generation_time_ms": int(generation_time * 1000)
-            }
-        })
+        return jsonify(build_generation_result(
+            hosted, response_text, prompt, activations_hash, input_positions, mid_layer, hidden_states_shape, generation_time
+        ))
         
+    except UnknownModel as e:
+        return jsonify({"output": f"Error: {str(e)}", "status": "unknown_model"}), 404
+    except ModelLoading as e:
+        logger.info(str(e))
+        return jsonify({"output": f"Error: {str(e)}", "status": "loading"}), 503, {"Retry-After": str(e.retry_after)}
+    except ModelUnavailable as e:
+        logger.error(f"Model unavailable: {str(e)}")
+        return jsonify({"output": f"Error: {str(e)}", "status": "unavailable"}), 503
+    except GenerationCancelled as e:
+        logger.warning(f"Generation cancelled: {str(e)}")
+        return jsonify({"output": f"Error: {str(e)}", "status": "timeout"}), 504
     except Exception as e:
         logger.error(f"Error generating response: {str(e)}")
         logger.error(traceback.format_exc())
         error_msg = f"Error generating response: {str(e)}"
         return jsonify({"output": error_msg})
+    finally:
+        if hosted is not None:
+            models.release(hosted)
 
 @app.route('/health', methods=['GET'])
 def health():
     """Health check endpoint"""
     return jsonify({
         "status": "ok",
-        "model_type": "TinyLlama-1.1B-Chat-v1.0 (Node2)",
+        "model_type": f"{default_model.spec.display_name} (Node2)",
         "layers": f"{len(model.layers)} layers (second half)",
+        "scheduler": step_scheduler.stats(),
+        "cpu": cpu_tuner.stats(),
+        "compilation": shard_compiler.stats(),
+        "prefill_sessions": len(prefill_sessions),
+        "attestation": attestations.stats(),
+        "models": models.stats(),
         "memory_usage": f"{torch.cuda.memory_allocated() / (1024 ** 3):.2f} GB" if torch.cuda.is_available() else "CPU only"
     })
 
 @app.route('/verify', methods=['GET'])
 def verify_model():
-    """Endpoint to verify the model's identity and integrity"""
-    if model_hash:
+    """Endpoint to verify the model's identity and integrity (?model= for a non-default model)"""
+    model_id = request.args.get("model") or models.default_model_id
+    if model_id not in models.specs:
+        return jsonify({"error": f"Unknown model: {model_id}", "status": "error"}), 404
+    hosted = models.get_loaded(model_id)
+    if hosted is None:
+        return jsonify({"model": model_id, "status": "not_loaded", "message": "Model is loaded on first use"})
+    if hosted.model_hash:
         response = {
-            "model_hash": model_hash,
+            "model": model_id,
+            "model_hash": hosted.model_hash,
             "model_info": {
-                "total_layers": len(model.layers),
-                "model_type": "TinyLlama-1.1B-Chat-v1.0 (Node2 - Second Half)"
+                "total_layers": len(hosted.model.layers),
+                "model_type": f"{hosted.spec.display_name} (Node2 - Second Half)"
             }
         }
         return jsonify(response)
@@ -0,0 +1,238 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+logger = logging.getLogger('attestation')
+
+# Domain separation so a leaf can never be passed off as an interior node
+LEAF_PREFIX = b"\x00"
+NODE_PREFIX = b"\x01"
+
+# Offset and size of REPORTDATA in a TDX (v4) quote: 48-byte header + 520 bytes into the TD report
+REPORT_DATA_OFFSET = 568
+REPORT_DATA_SIZE = 64
+
+
+class AttestationVerificationError(Exception):
+    """Raised when an attested record does not match its proof or quote"""
+
+
+def sha256_hex(data):
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
+
+
+def leaf_hash(record):
+    """Hash of one request record, over its canonical JSON encoding"""
+    encoded = json.dumps(record, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(LEAF_PREFIX + encoded.encode("utf-8")).digest()
+
+
+def node_hash(left, right):
+    return hashlib.sha256(NODE_PREFIX + left + right).digest()
+
+
+def build_merkle_levels(leaves):
+    """
+    All levels of the Merkle tree, leaves first and the root last. An odd node at the
+    end of a level is carried up unchanged rather than paired with a copy of itself.
+    """
+    levels = [list(leaves)]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        parents = [node_hash(level[i], level[i + 1]) for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            parents.append(level[-1])
+        levels.append(parents)
+    return levels
+
+
+def inclusion_proof(levels, index):
+    """Sibling hashes from leaf `index` up to the root, each with the side it sits on"""
+    proof = []
+    for level in levels[:-1]:
+        sibling = index ^ 1
+        if sibling < len(level):
+            proof.append({"side": "left" if sibling < index else "right", "hash": level[sibling].hex()})
+        index //= 2
+    return proof
+
+
+def root_from_proof(leaf, proof):
+    digest = leaf
+    for step in proof:
+        sibling = bytes.fromhex(step["hash"])
+        digest = node_hash(sibling, digest) if step["side"] == "left" else node_hash(digest, sibling)
+    return digest
+
+
+def quote_report_data(quote_hex):
+    """REPORTDATA field of a hex-encoded TDX quote"""
+    quote = bytes.fromhex(quote_hex[2:] if quote_hex.startswith("0x") else quote_hex)
+    if len(quote) < REPORT_DATA_OFFSET + REPORT_DATA_SIZE:
+        raise AttestationVerificationError(f"Quote too short ({len(quote)} bytes) to contain report data")
+    return quote[REPORT_DATA_OFFSET:REPORT_DATA_OFFSET + REPORT_DATA_SIZE]
+
+
+def raw_report_data(data):
+    """
+    REPORTDATA the dstack SDK builds for raw report data: the bytes zero-padded on the
+    left to 64 bytes (it left-pads their hex to 128 digits)
+    """
+    if len(data) > REPORT_DATA_SIZE:
+        raise ValueError(f"Raw report data is {len(data)} bytes, more than {REPORT_DATA_SIZE}")
+    return data.rjust(REPORT_DATA_SIZE, b"\x00")
+
+
+def verify_attestation(attestation, prompt=None, output=None):
+    """
+    Check one response's attestation: the record hashes to its leaf, the inclusion proof
+    leads to the Merkle root, and the root is the REPORTDATA of the quote. With `prompt`
+    or `output`, also check they are what the record commits to. Verifying the quote's
+    own signature chain and measurements is left to a DCAP verifier. Returns the record;
+    raises AttestationVerificationError on any mismatch.
+    """
+    merkle = attestation.get("merkle")
+    if not merkle:
+        raise AttestationVerificationError("Attestation has no Merkle proof")
+    record = merkle["record"]
+
+    if prompt is not None and record.get("prompt_hash") != sha256_hex(prompt):
+        raise AttestationVerificationError("Prompt does not match the attested prompt_hash")
+    if output is not None and record.get("output_hash") != sha256_hex(output):
+        raise AttestationVerificationError("Output does not match the attested output_hash")
+
+    leaf = leaf_hash(record)
+    if leaf.hex() != merkle["leaf_hash"]:
+        raise AttestationVerificationError("Record does not hash to the attested leaf")
+    root = root_from_proof(leaf, merkle["proof"])
+    if root.hex() != merkle["root"]:
+        raise AttestationVerificationError("Inclusion proof does not lead to the Merkle root")
+
+    report_data = quote_report_data(attestation["ra_report"]["quote"])
+    if report_data != raw_report_data(root):
+        raise AttestationVerificationError("Quote report data is not the Merkle root")
+    return record
+
+
+class _Pending:
+    def __init__(self, record):
+        self.record = record
+        self.future = Future()
+        self.submitted = time.monotonic()
+
+
+class AttestationAggregator:
+    """
+    Batch per-request attestations into one quote.
+
+    Records submitted within `window` seconds of the first pending one (or until
+    `max_batch` are pending) become the leaves of a Merkle tree, and a single quote is
+    requested with the root as raw report data. Each request gets the shared quote plus
+    its own record and inclusion proof, so it stays verifiable on its own with
+    `verify_attestation`. Records that arrive while a quote is being generated form
+    the next batch, so the quote rate is bounded by the quote latency under load.
+    """
+
+    def __init__(self, get_ra_data, window=0.2, max_batch=1024):
+        self.get_ra_data = get_ra_data
+        self.window = window
+        self.max_batch = max_batch
+        self.latest = None
+
+        self._cond = threading.Condition()
+        self._pending = []
+        self._thread = None
+
+        # Statistics reported on /health
+        self.batches = 0
+        self.records = 0
+        self.largest_batch = 0
+        self.last_quote_time = None
+
+    def submit(self, record):
+        """Queue a record for the next batch; the Future resolves to its attestation"""
+        entry = _Pending(record)
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="attestation-batcher", daemon=True)
+                self._thread.start()
+            self._pending.append(entry)
+            self._cond.notify_all()
+        return entry.future
+
+    def attest(self, record, timeout=None):
+        return self.submit(record).result(timeout)
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+            # The batch closes when the window since its first record elapses or it is full
+            closes_at = self._pending[0].submitted + self.window
+            while len(self._pending) < self.max_batch:
+                remaining = closes_at - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch = self._pending[:self.max_batch]
+            del self._pending[:self.max_batch]
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                self._attest_batch(batch)
+            except Exception as e:
+                logger.error(f"Attestation batch of {len(batch)} failed: {str(e)}")
+                for entry in batch:
+                    if not entry.future.done():
+                        entry.future.set_exception(e)
+
+    def _attest_batch(self, batch):
+        leaves = [leaf_hash(entry.record) for entry in batch]
+        levels = build_merkle_levels(leaves)
+        root = levels[-1][0].hex()
+
+        started = time.monotonic()
+        ra_data = self.get_ra_data(root, "raw")
+        self.last_quote_time = time.monotonic() - started
+        logger.info(f"Attested {len(batch)} records under root {root[:16]}... in {self.last_quote_time:.2f}s")
+
+        with self._cond:
+            self.batches += 1
+            self.records += len(batch)
+            self.largest_batch = max(self.largest_batch, len(batch))
+
+        for index, entry in enumerate(batch):
+            if "error" in ra_data:
+                entry.future.set_result(dict(ra_data))
+                continue
+            attestation = dict(ra_data, merkle={
+                "record": entry.record,
+                "leaf_hash": leaves[index].hex(),
+                "leaf_index": index,
+                "leaf_count": len(batch),
+                "proof": inclusion_proof(levels, index),
+                "root": root,
+            })
+            self.latest = attestation
+            entry.future.set_result(attestation)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "window_ms": int(self.window * 1000),
+                "max_batch": self.max_batch,
+                "pending": len(self._pending),
+                "quotes": self.batches,
+                "records": self.records,
+                "records_per_quote": round(self.records / self.batches, 2) if self.batches else 0.0,
+                "largest_batch": self.largest_batch,
+                "last_quote_s": round(self.last_quote_time, 3) if self.last_quote_time is not None else None,
+            }
@@ -0,0 +1,54 @@
+class IncrementalDetokenizer:
+    """
+    Turn generated token ids into text one step at a time.
+
+    Only a short window of recent tokens is re-decoded per step, so the cost does not grow
+    with the output length. Text is held back while the window ends in an incomplete
+    multi-byte character (decoded as U+FFFD), and SentencePiece word-boundary spaces are
+    kept because the window always starts at an earlier token.
+    """
+
+    def __init__(self, tokenizer, skip_special_tokens=True):
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.token_ids = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+        self.text = ""
+
+    def _decode(self, token_ids):
+        return self.tokenizer.decode(token_ids, skip_special_tokens=self.skip_special_tokens)
+
+    def add(self, token_ids):
+        """Append new token ids and return the newly completed text (possibly empty)"""
+        self.token_ids.extend(token_ids)
+        prefix_text = self._decode(self.token_ids[self.prefix_offset:self.read_offset])
+        new_text = self._decode(self.token_ids[self.prefix_offset:])
+
+        if len(new_text) <= len(prefix_text) or new_text.endswith("\ufffd"):
+            return ""
+
+        delta = new_text[len(prefix_text):]
+        self.prefix_offset = self.read_offset
+        self.read_offset = len(self.token_ids)
+        self.text += delta
+        return delta
+
+    def flush(self):
+        """Return any text still held back, e.g. a trailing partial character"""
+        prefix_text = self._decode(self.token_ids[self.prefix_offset:self.read_offset])
+        new_text = self._decode(self.token_ids[self.prefix_offset:])
+        delta = new_text[len(prefix_text):]
+        self.prefix_offset = self.read_offset = len(self.token_ids)
+        self.text += delta
+        return delta
+
+    def stream(self, token_iterator):
+        """Yield text deltas for an iterator of [batch, 1] token tensors (batch element 0)"""
+        for next_token in token_iterator:
+            delta = self.add([next_token[0, 0].item()])
+            if delta:
+                yield delta
+        delta = self.flush()
+        if delta:
+            yield delta
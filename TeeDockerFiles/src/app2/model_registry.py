@@ -0,0 +1,318 @@
+import gc
+import itertools
+import json
+import logging
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import torch
+
+logger = logging.getLogger('model_registry')
+
+
+class UnknownModel(Exception):
+    """Raised for a model id the registry does not list"""
+
+
+class ModelUnavailable(Exception):
+    """Raised when a model fails to load, fails hash verification or does not fit the memory budget"""
+
+
+class ModelLoading(ModelUnavailable):
+    """Raised while a model is being loaded in the background; carries a Retry-After estimate"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class ModelSpec:
+    """
+    One servable model from the registry config. `expected_hash` is either one hash or a
+    mapping of node name ("node1", "node2") to the hash that node's shard must produce.
+    """
+
+    def __init__(self, model_id, path, gdrive_id=None, expected_hash=None, display_name=None, memory_gb=None):
+        self.model_id = model_id
+        self.path = path
+        self.gdrive_id = gdrive_id
+        self.expected_hash = expected_hash
+        self.display_name = display_name or model_id
+        self.memory_gb = memory_gb
+
+    @classmethod
+    def from_dict(cls, model_id, data):
+        return cls(
+            model_id,
+            data["path"],
+            gdrive_id=data.get("gdrive_id"),
+            expected_hash=data.get("model_hash"),
+            display_name=data.get("name"),
+            memory_gb=data.get("memory_gb"),
+        )
+
+    def expected_hash_for(self, node):
+        if isinstance(self.expected_hash, dict):
+            return self.expected_hash.get(node)
+        return self.expected_hash
+
+
+def shard_size_bytes(model):
+    """Bytes held by a shard's materialized parameters and buffers (meta tensors excluded)"""
+    return sum(
+        t.numel() * t.element_size()
+        for t in itertools.chain(model.parameters(), model.buffers())
+        if t.device.type != "meta"
+    )
+
+
+class HostedModel:
+    """A loaded shard with what serving it needs"""
+
+    def __init__(self, spec, model, model_hash, model_info, tokenizer=None, chat_tokenizer=None, pinned=False):
+        self.spec = spec
+        self.model = model
+        self.model_hash = model_hash
+        self.model_info = model_info
+        self.tokenizer = tokenizer
+        self.chat_tokenizer = chat_tokenizer
+        self.pinned = pinned
+        self.size_bytes = shard_size_bytes(model)
+        self.loaded_at = time.time()
+        self.last_used = time.monotonic()
+        self.in_use = 0
+
+    @property
+    def model_id(self):
+        return self.spec.model_id
+
+
+class ModelRegistry:
+    """
+    Models this node can serve, chosen per request by model id.
+
+    The first request for a model starts loading it by `loader(spec)` on a single
+    background thread and gets ModelLoading (503 with Retry-After), as do requests
+    arriving while it loads; request threads never wait on a load, so admission limits
+    and deadlines still hold. The shard's model_hash must match the registry's expected
+    hash for this node, if one is given. A model that failed to load is not retried for
+    `retry_failed_after` seconds. When loaded shards exceed `memory_budget` bytes, idle
+    ones are evicted least recently used first. A spec's `memory_gb` lets room be made
+    before loading rather than after. Shards that are in use (acquired and not yet
+    released) and pinned ones are never evicted.
+    """
+
+    def __init__(self, specs, loader, node, default_model_id, memory_budget=None, retry_failed_after=60.0):
+        self.specs = dict(specs)
+        self.loader = loader
+        self.node = node
+        self.default_model_id = default_model_id
+        self.memory_budget = memory_budget
+        self.retry_failed_after = retry_failed_after
+
+        self._lock = threading.Lock()
+        self._loaded = {}
+        self._loading = {}  # model id -> time.monotonic() the load was queued
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="model-load")
+        self.loads = 0
+        self.evictions = 0
+        self.failures = {}  # model id -> (error, time.monotonic() of the failure)
+        self.avg_load_s = None
+
+    @classmethod
+    def from_env(cls, loader, node, default):
+        """
+        Build the registry around the already loaded default model. MODEL_REGISTRY names a
+        JSON file {"models": {model_id: {"path", "gdrive_id", "model_hash", "name", "memory_gb"}}};
+        MODEL_MEMORY_BUDGET_GB caps the memory of loaded shards and MODEL_LOAD_RETRY_S is
+        how long a failed model is refused before it is loaded again.
+        """
+        specs = {default.model_id: default.spec}
+        config_path = os.environ.get("MODEL_REGISTRY")
+        if config_path:
+            with open(config_path) as f:
+                config = json.load(f)
+            for model_id, data in config.get("models", {}).items():
+                specs[model_id] = ModelSpec.from_dict(model_id, data)
+
+        budget_gb = os.environ.get("MODEL_MEMORY_BUDGET_GB")
+        registry = cls(
+            specs, loader, node, default.model_id,
+            memory_budget=float(budget_gb) * 1024 ** 3 if budget_gb else None,
+            retry_failed_after=float(os.environ.get("MODEL_LOAD_RETRY_S", "60")),
+        )
+        # The default model's config entry, if any, supplies its expected hash
+        default.spec = specs[default.model_id]
+        registry.add_loaded(default)
+        return registry
+
+    def _verify(self, hosted):
+        expected = hosted.spec.expected_hash_for(self.node)
+        if expected and expected != hosted.model_hash:
+            raise ModelUnavailable(
+                f"Model {hosted.model_id} failed verification: hash {hosted.model_hash} != expected {expected}"
+            )
+
+    def add_loaded(self, hosted):
+        """Register a model loaded outside the registry (the default one); it is pinned"""
+        self._verify(hosted)
+        hosted.pinned = True
+        with self._lock:
+            self._loaded[hosted.model_id] = hosted
+        logger.info(f"Serving {hosted.model_id} ({hosted.size_bytes / 1024 ** 3:.2f} GB, hash {hosted.model_hash})")
+
+    def _used_bytes(self):
+        return sum(h.size_bytes for h in self._loaded.values())
+
+    def _evict_until(self, limit, keep=None):
+        """Evict idle, unpinned models, least recently used first, until usage is within `limit`"""
+        idle = sorted(
+            (h for h in self._loaded.values() if h.in_use == 0 and not h.pinned and h.model_id != keep),
+            key=lambda h: h.last_used,
+        )
+        evicted = []
+        for hosted in idle:
+            if self._used_bytes() <= limit:
+                break
+            del self._loaded[hosted.model_id]
+            self.evictions += 1
+            evicted.append(hosted)
+            logger.info(f"Evicted {hosted.model_id} ({hosted.size_bytes / 1024 ** 3:.2f} GB)")
+        return evicted
+
+    @staticmethod
+    def _free(evicted):
+        for hosted in evicted:
+            hosted.model = None
+        if evicted:
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+    def acquire(self, model_id=None):
+        """
+        Return the model for `model_id` (default when None) and hold it until release().
+        Raises ModelLoading if it is not loaded yet, starting the load if none is running.
+        """
+        model_id = model_id or self.default_model_id
+        spec = self.specs.get(model_id)
+        if spec is None:
+            raise UnknownModel(f"Unknown model: {model_id}")
+
+        with self._lock:
+            hosted = self._loaded.get(model_id)
+            if hosted is not None:
+                hosted.in_use += 1
+                hosted.last_used = time.monotonic()
+                return hosted
+
+            failure = self.failures.get(model_id)
+            if failure is not None and time.monotonic() - failure[1] < self.retry_failed_after:
+                raise ModelUnavailable(failure[0])
+
+            queued_at = self._loading.get(model_id)
+            if queued_at is None:
+                queued_at = self._loading[model_id] = time.monotonic()
+                self._executor.submit(self._load, spec)
+            # Loads run one at a time, so count the ones queued ahead of this one
+            ahead = sum(1 for t in self._loading.values() if t < queued_at)
+            expected = (self.avg_load_s or 30.0) * (ahead + 1)
+            retry_after = max(1, math.ceil(expected - (time.monotonic() - queued_at)))
+        raise ModelLoading(f"Model {model_id} is loading, retry in about {retry_after}s", retry_after)
+
+    def _load(self, spec):
+        """Load one model on the loader thread, making room under the budget"""
+        model_id = spec.model_id
+        with self._lock:
+            evicted = []
+            if self.memory_budget is not None and spec.memory_gb:
+                evicted = self._evict_until(self.memory_budget - spec.memory_gb * 1024 ** 3)
+        self._free(evicted)
+
+        logger.info(f"Loading {model_id} from {spec.path} on first use...")
+        started = time.time()
+        try:
+            hosted = self.loader(spec)
+            self._verify(hosted)
+        except Exception as e:
+            message = str(e) if isinstance(e, ModelUnavailable) else f"Could not load {model_id}: {str(e)}"
+            logger.error(message)
+            gc.collect()  # Drop whatever the failed load had allocated
+            with self._lock:
+                self.failures[model_id] = (message, time.monotonic())
+                del self._loading[model_id]
+            return
+
+        load_s = time.time() - started
+        with self._lock:
+            self.failures.pop(model_id, None)
+            self._loaded[model_id] = hosted
+            del self._loading[model_id]
+            self.loads += 1
+            self.avg_load_s = load_s if self.avg_load_s is None else 0.7 * self.avg_load_s + 0.3 * load_s
+            evicted = []
+            if self.memory_budget is not None:
+                evicted = self._evict_until(self.memory_budget, keep=model_id)
+            over_budget = self.memory_budget is not None and self._used_bytes() > self.memory_budget
+        self._free(evicted)
+        logger.info(f"Loaded {model_id} in {load_s:.1f}s "
+                    f"({hosted.size_bytes / 1024 ** 3:.2f} GB, hash {hosted.model_hash})")
+        if over_budget:
+            logger.warning("Loaded models exceed the memory budget; every other model is in use or pinned")
+
+    def release(self, hosted):
+        with self._lock:
+            hosted.in_use -= 1
+            hosted.last_used = time.monotonic()
+            evicted = []
+            # A load that found every other model busy may have left us over budget
+            if self.memory_budget is not None and self._used_bytes() > self.memory_budget:
+                evicted = self._evict_until(self.memory_budget)
+        self._free(evicted)
+
+    @contextmanager
+    def lease(self, model_id=None):
+        hosted = self.acquire(model_id)
+        try:
+            yield hosted
+        finally:
+            self.release(hosted)
+
+    def get_loaded(self, model_id=None):
+        """The model if it is loaded, without loading it or counting a use"""
+        with self._lock:
+            return self._loaded.get(model_id or self.default_model_id)
+
+    def stats(self):
+        with self._lock:
+            models = {}
+            for model_id, spec in self.specs.items():
+                hosted = self._loaded.get(model_id)
+                entry = {"name": spec.display_name, "loaded": hosted is not None, "loading": model_id in self._loading}
+                if hosted is not None:
+                    entry.update({
+                        "model_hash": hosted.model_hash,
+                        "verified": bool(spec.expected_hash_for(self.node)),
+                        "size_gb": round(hosted.size_bytes / 1024 ** 3, 3),
+                        "in_use": hosted.in_use,
+                        "pinned": hosted.pinned,
+                        "idle_s": round(time.monotonic() - hosted.last_used, 1),
+                    })
+                if model_id in self.failures:
+                    error, failed_at = self.failures[model_id]
+                    entry["last_error"] = error
+                    entry["retry_in_s"] = round(max(0.0, self.retry_failed_after - (time.monotonic() - failed_at)), 1)
+                models[model_id] = entry
+            return {
+                "default": self.default_model_id,
+                "memory_budget_gb": round(self.memory_budget / 1024 ** 3, 2) if self.memory_budget else None,
+                "used_gb": round(self._used_bytes() / 1024 ** 3, 3),
+                "loads": self.loads,
+                "avg_load_s": round(self.avg_load_s, 2) if self.avg_load_s is not None else None,
+                "evictions": self.evictions,
+                "models": models,
+            }
@@ -0,0 +1,262 @@
+import inspect
+import logging
+import time
+from contextlib import nullcontext
+
+import torch
+from transformers import DynamicCache
+from transformers.modeling_outputs import CausalLMOutputWithPast
+from transformers.models.llama.modeling_llama import LlamaDecoderLayer
+
+from profiling import region
+
+logger = logging.getLogger('node2')
+
+# Decoder layers take the KV cache as `past_key_values` in newer transformers releases
+# and as `past_key_value` in older ones
+CACHE_KWARG = (
+    "past_key_values"
+    if "past_key_values" in inspect.signature(LlamaDecoderLayer.forward).parameters
+    else "past_key_value"
+)
+
+def build_causal_mask(attention_mask, query_length, dtype, attn_implementation=None):
+    """
+    Build the 4-D additive causal mask [batch, 1, query, key] shared by every layer.
+
+    `attention_mask` is the 2-D 0/1 mask over all key positions (cached + current).
+    Returns None when SDPA can apply causality itself, which lets it pick a fused kernel.
+    """
+    key_length = attention_mask.shape[-1]
+    past_length = key_length - query_length
+    no_padding = bool(attention_mask.all())
+
+    if attn_implementation == "sdpa" and no_padding and (past_length == 0 or query_length == 1):
+        return None
+
+    device = attention_mask.device
+    query_positions = torch.arange(past_length, key_length, device=device).unsqueeze(-1)
+    key_positions = torch.arange(key_length, device=device).unsqueeze(0)
+    allowed = (key_positions <= query_positions).unsqueeze(0).unsqueeze(0)
+    allowed = allowed & attention_mask[:, None, None, :].bool()
+
+    mask = torch.zeros(allowed.shape, dtype=dtype, device=device)
+    return mask.masked_fill(~allowed, torch.finfo(dtype).min)
+
+def run_decoder_layer(layer, hidden_states, causal_mask, position_ids, position_embeddings, past_key_values=None):
+    """Run one decoder layer with the shared mask and rotary embeddings"""
+    layer_kwargs = {
+        "attention_mask": causal_mask,
+        "position_ids": position_ids,
+        "position_embeddings": position_embeddings,
+        "use_cache": past_key_values is not None,
+        CACHE_KWARG: past_key_values,
+    }
+    layer_outputs = layer(hidden_states, **layer_kwargs)
+    # Older releases return a tuple, newer ones return the hidden states tensor
+    return layer_outputs[0] if isinstance(layer_outputs, tuple) else layer_outputs
+
+def make_layer_benchmark(layer, rotary_emb, config, workload):
+    """
+    Return a function running `layer` once per (seq_length, count) entry of `workload`,
+    on fixed random activations, for timing thread settings on this host.
+    """
+    param = next(layer.parameters())
+    inputs = []
+    for seq_length, count in workload:
+        hidden_states = torch.randn(1, seq_length, config.hidden_size, dtype=param.dtype, device=param.device)
+        position_ids = torch.arange(seq_length, device=param.device).unsqueeze(0)
+        causal_mask = build_causal_mask(
+            torch.ones((1, seq_length), dtype=torch.long, device=param.device), seq_length, param.dtype,
+            getattr(config, "_attn_implementation", None)
+        )
+        inputs.append((count, hidden_states, causal_mask, position_ids, rotary_emb(hidden_states, position_ids)))
+
+    def benchmark():
+        with torch.no_grad():
+            for count, hidden_states, causal_mask, position_ids, position_embeddings in inputs:
+                for _ in range(count):
+                    run_decoder_layer(layer, hidden_states, causal_mask, position_ids, position_embeddings)
+
+    return benchmark
+
+class GenerationCancelled(Exception):
+    """Raised when generation runs past the request deadline sent by Node1"""
+
+def sample_top_p(next_token_logits, temperature, top_p):
+    """Sample one token per row from temperature-scaled, nucleus-filtered logits"""
+    # Apply temperature
+    next_token_logits = next_token_logits / temperature
+    
+    # Apply top-p sampling
+    sorted_logits, sorted_indices = torch.sort(next_token_logits, descending=True)
+    cumulative_probs = torch.cumsum(torch.softmax(sorted_logits, dim=-1), dim=-1)
+    
+    # Remove tokens with cumulative probability above the threshold
+    sorted_indices_to_remove = cumulative_probs > top_p
+    # Shift the indices to the right to keep the first token above threshold
+    sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[..., :-1].clone()
+    sorted_indices_to_remove[..., 0] = 0
+    
+    for batch_idx in range(next_token_logits.shape[0]):
+        indices_to_remove = sorted_indices[batch_idx][sorted_indices_to_remove[batch_idx]]
+        next_token_logits[batch_idx, indices_to_remove] = -float("Inf")
+    
+    # Sample from the filtered distribution
+    probs = torch.softmax(next_token_logits, dim=-1)
+    return torch.multinomial(probs, num_samples=1)
+
+# Create a custom class for Node2 model that starts from the middle layer
+class Node2Model(torch.nn.Module):
+    def __init__(self, base_model, middle_layer):
+        super().__init__()
+        self.config = base_model.config
+        self.embed_tokens = base_model.model.embed_tokens  # Needed for vocab projections
+        self.norm = base_model.model.norm
+        self.lm_head = base_model.lm_head
+        # Rotary embeddings are computed once per step and shared by all layers
+        self.rotary_emb = base_model.model.rotary_emb
+        
+        # Only include the second half of layers
+        self.middle_layer = middle_layer
+        self.layers = base_model.model.layers[middle_layer:]
+        # Renumber attention layers so this shard's KV cache starts at slot 0
+        for idx, layer in enumerate(self.layers):
+            layer.self_attn.layer_idx = idx
+        
+        logger.info(f"Node2 initialized with layers {middle_layer} to {len(base_model.model.layers)-1}")
+
+    def forward(self, hidden_states, attention_mask=None, position_ids=None, past_key_values=None,
+                output_hidden_states=True, last_logits_only=False):
+        batch_size, seq_length = hidden_states.shape[:2]
+        device = hidden_states.device
+        past_length = past_key_values.get_seq_length() if past_key_values is not None else 0
+
+        if attention_mask is None:
+            attention_mask = torch.ones((batch_size, past_length + seq_length), dtype=torch.long, device=device)
+        if position_ids is None:
+            position_ids = torch.arange(past_length, past_length + seq_length, device=device).unsqueeze(0)
+
+        # Build the causal mask and rotary cos/sin once for all layers
+        causal_mask = build_causal_mask(
+            attention_mask, seq_length, hidden_states.dtype, getattr(self.config, "_attn_implementation", None)
+        )
+        position_embeddings = self.rotary_emb(hidden_states, position_ids)
+
+        # Store all hidden states if requested
+        all_hidden_states = () if output_hidden_states else None
+        
+        # Process through the second half of layers
+        for idx, layer in enumerate(self.layers):
+            if output_hidden_states:
+                all_hidden_states = all_hidden_states + (hidden_states,)
+                
+            # Process through this layer
+            hidden_states = run_decoder_layer(
+                layer, hidden_states, causal_mask, position_ids, position_embeddings, past_key_values
+            )
+            
+        # Only the last position's logits are needed while generating
+        if last_logits_only:
+            hidden_states = hidden_states[:, -1:, :]
+        
+        # Apply final normalization
+        hidden_states = self.norm(hidden_states)
+        
+        # Get logits from the final hidden states
+        logits = self.lm_head(hidden_states)
+        
+        # Return the output and the hidden_states
+        return CausalLMOutputWithPast(
+            logits=logits,
+            past_key_values=past_key_values,
+            hidden_states=all_hidden_states,
+            attentions=None
+        )
+    
+    def generate(self, hidden_states, input_ids, attention_mask=None, position_ids=None, 
+                max_new_tokens=128, temperature=0.7, top_p=0.9):
+        """
+        Generate text by continuing from the provided hidden states
+        """
+        new_tokens = list(self.stream_generate(
+            hidden_states, attention_mask=attention_mask, position_ids=position_ids,
+            max_new_tokens=max_new_tokens, temperature=temperature, top_p=top_p
+        ))
+        return torch.cat([input_ids] + new_tokens, dim=-1)
+
+    def stream_generate(self, hidden_states, attention_mask=None, position_ids=None,
+                        max_new_tokens=128, temperature=0.7, top_p=0.9, deadline=None,
+                        past_key_values=None, step_guard=nullcontext):
+        """
+        Yield each sampled token ([batch, 1]) as soon as it is produced, ending after EOS.
+        Prompt tokens are never needed; the prompt length is taken from the hidden states
+        plus any positions already in `past_key_values` (earlier prefill chunks).
+        `deadline` is a time.monotonic() value after which generation is cancelled.
+        `step_guard()` wraps every forward step, e.g. to take turns with other requests.
+        """
+        batch_size, chunk_length = hidden_states.shape[:2]
+        device = hidden_states.device
+        past_length = past_key_values.get_seq_length() if past_key_values is not None else 0
+        prompt_length = past_length + chunk_length
+        
+        # Start with initial hidden states from Node1
+        current_hidden_states = hidden_states
+        
+        # Keep track of attention_mask and position_ids
+        if attention_mask is None:
+            attention_mask = torch.ones((batch_size, prompt_length), dtype=torch.long, device=device)
+        else:
+            attention_mask = attention_mask.to(device)
+            
+        if position_ids is None:
+            position_ids = torch.arange(past_length, prompt_length, device=device).unsqueeze(0)
+        else:
+            position_ids = position_ids.to(device)
+
+        # Keys/values of earlier positions are cached so each step only runs the new token
+        if past_key_values is None:
+            past_key_values = DynamicCache()
+            
+        # Start generation loop
+        for i in range(max_new_tokens):
+            if deadline is not None and time.monotonic() >= deadline:
+                raise GenerationCancelled(f"Deadline exceeded after {i} generated tokens")
+            
+            with torch.no_grad():
+                # Process current hidden states through our layers
+                with step_guard():
+                    outputs = self.forward(
+                        current_hidden_states, 
+                        attention_mask=attention_mask,
+                        position_ids=position_ids,
+                        past_key_values=past_key_values,
+                        output_hidden_states=False,
+                        last_logits_only=True
+                    )
+                
+                # Sample the next token from the last position's logits
+                with region("node2.sample"):
+                    next_token = sample_top_p(outputs.logits[:, -1, :], temperature, top_p)
+                
+                # Hand the token to the caller
+                yield next_token
+                
+                # Check if we've hit the end of sequence token
+                if next_token[0, 0].item() == self.config.eos_token_id:
+                    break
+                
+                # Prepare for the next iteration
+                # Extend attention_mask; the new token sits one position past the last one
+                attention_mask = torch.cat([
+                    attention_mask, 
+                    torch.ones((batch_size, 1), dtype=attention_mask.dtype, device=device)
+                ], dim=-1)
+                
+                position_ids = position_ids[:, -1:] + 1
+                
+                # Embed the new token to create the next hidden state
+                token_embeds = self.embed_tokens(next_token)
+                
+                # Process this token through all layers 
+                current_hidden_states = token_embeds
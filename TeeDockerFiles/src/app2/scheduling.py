@@ -0,0 +1,46 @@
+import threading
+import time
+from contextlib import contextmanager
+
+
+class StepScheduler:
+    """
+    FIFO lock around individual model steps (one prefill chunk or one decode step).
+
+    Concurrent requests take turns step by step in arrival order, so a long prompt
+    being prefilled in chunks cannot stall the decode steps of other requests for
+    more than one chunk. Running one step at a time also keeps PyTorch's intra-op
+    thread pool from being oversubscribed by parallel forward passes.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._next_ticket = 0
+        self._now_serving = 0
+        self.steps = 0
+        self.total_wait = 0.0
+
+    @contextmanager
+    def step(self):
+        queued_at = time.monotonic()
+        with self._cond:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            while ticket != self._now_serving:
+                self._cond.wait()
+            self.steps += 1
+            self.total_wait += time.monotonic() - queued_at
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._now_serving += 1
+                self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "steps": self.steps,
+                "waiting": self._next_ticket - self._now_serving,
+                "avg_step_wait_ms": round(1000 * self.total_wait / self.steps, 2) if self.steps else 0.0,
+            }
@@ -0,0 +1,188 @@
+import fcntl
+import glob
+import json
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import warnings
+from contextlib import contextmanager
+
+import torch
+from accelerate import init_empty_weights
+from transformers import AutoConfig, AutoModelForCausalLM
+
+logger = logging.getLogger('weight_store')
+
+# safetensors dtype names
+DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+DTYPE_NAMES = {dtype: name for name, dtype in DTYPES.items()}
+
+
+def shard_keys(state_dict_keys, layer_range, include_lm_head):
+    """Names of the full-model tensors a node needs for layers [start, end)"""
+    start, end = layer_range
+    keys = []
+    for name in state_dict_keys:
+        if name.startswith("model.layers."):
+            layer = int(name.split(".")[2])
+            if start <= layer < end:
+                keys.append(name)
+        elif name.startswith(("model.embed_tokens.", "model.norm.")):
+            keys.append(name)
+        elif name.startswith("lm_head.") and include_lm_head:
+            keys.append(name)
+    return keys
+
+
+def write_store(full_model, path):
+    """
+    Save the model weights in the serving dtype as one safetensors file. Tensors are
+    written one at a time straight from the model, so converting needs no memory beyond
+    the loaded model itself (safetensors' save_file builds a second copy of every tensor).
+    """
+    tensors = {}
+    seen_storage = set()
+    for name, tensor in full_model.state_dict().items():
+        # Tied weights (e.g. lm_head sharing embed_tokens) are stored once and re-tied on load
+        if tensor.data_ptr() in seen_storage:
+            continue
+        seen_storage.add(tensor.data_ptr())
+        tensors[name] = tensor
+
+    header = {}
+    offset = 0
+    for name, tensor in tensors.items():
+        size = tensor.numel() * tensor.element_size()
+        header[name] = {"dtype": DTYPE_NAMES[tensor.dtype], "shape": list(tensor.shape), "data_offsets": [offset, offset + size]}
+        offset += size
+    header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    header_bytes += b" " * (-len(header_bytes) % 8)  # Tensor data starts 8-byte aligned
+
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    # A unique name: PIDs repeat across containers sharing the directory (both are PID 1)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f"{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(struct.pack("<Q", len(header_bytes)))
+            f.write(header_bytes)
+            for tensor in tensors.values():
+                # Raw bytes of one tensor; a CPU tensor that is already contiguous is not copied
+                f.write(tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy())
+        os.chmod(tmp_path, 0o644)  # mkstemp creates it private to this user
+        os.replace(tmp_path, path)  # Atomic, so readers never see a partial file
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    logger.info(f"Wrote {len(tensors)} tensors to {path} ({os.path.getsize(path) / (1024 ** 3):.2f} GB)")
+
+
+def remove_stale_temp_files(path):
+    """Delete temp files left by a conversion that was killed; call only under conversion_lock"""
+    for tmp_path in glob.glob(f"{glob.escape(path)}.*.tmp"):
+        logger.warning(f"Removing {tmp_path} left by an interrupted conversion")
+        os.remove(tmp_path)
+
+
+@contextmanager
+def conversion_lock(path):
+    """Exclusive lock on `<path>.lock`, held while one process converts the store"""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(f"{path}.lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def read_header(path):
+    """Return the safetensors header (tensor name -> dtype/shape/offsets) and the data offset"""
+    with open(path, "rb") as f:
+        header_length = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_length))
+    header.pop("__metadata__", None)
+    return header, 8 + header_length
+
+
+def load_mmap_state_dict(path, keys=None):
+    """
+    Map a safetensors file read-only and return tensors that view the mapping directly.
+    With `keys`, only those tensors are returned (the rest of the file is never touched).
+
+    No weight data is copied: pages are loaded on demand and live in the OS page cache,
+    so every process mapping the same file shares one physical copy. The tensors must
+    never be written to (inference only reads weights).
+    """
+    header, data_start = read_header(path)
+    with open(path, "rb") as f:
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if keys is not None:
+        header = {name: header[name] for name in keys}
+
+    state_dict = {}
+    with warnings.catch_warnings():
+        # torch warns that the buffer is read-only; that is the point here
+        warnings.simplefilter("ignore", UserWarning)
+        for name, info in header.items():
+            dtype = DTYPES[info["dtype"]]
+            begin, end = info["data_offsets"]
+            count = (end - begin) // torch.empty((), dtype=dtype).element_size()
+            tensor = torch.frombuffer(mapping, dtype=dtype, count=count, offset=data_start + begin)
+            state_dict[name] = tensor.view(info["shape"])
+    return state_dict
+
+
+def load_shard_model(model_name, path, layer_range, include_lm_head, torch_dtype=torch.float16, **model_kwargs):
+    """
+    Build the full model skeleton without allocating weights, then attach this node's
+    tensors from the memory-mapped store. Layers outside `layer_range` stay on the meta
+    device and take no memory. Both nodes can map the same store file, so tensors they
+    share (embeddings, final norm) also share pages. The store is converted from the
+    checkpoint on first use, by one process at a time; the others wait and map the result.
+    """
+    if not os.path.exists(path):
+        with conversion_lock(path):
+            # Another node may have converted it while we waited for the lock
+            if not os.path.exists(path):
+                remove_stale_temp_files(path)
+                logger.info(f"Weight store {path} not found, converting from {model_name}...")
+                full_model = AutoModelForCausalLM.from_pretrained(
+                    model_name, torch_dtype=torch_dtype, low_cpu_mem_usage=True, **model_kwargs
+                )
+                write_store(full_model, path)
+                del full_model
+
+    config = AutoConfig.from_pretrained(model_name, local_files_only=model_kwargs.get("local_files_only", False))
+    config_kwargs = {}
+    if model_kwargs.get("attn_implementation"):
+        config_kwargs["attn_implementation"] = model_kwargs["attn_implementation"]
+
+    # Parameters go on the meta device; buffers such as rotary inv_freq are still real
+    with init_empty_weights(include_buffers=False):
+        full_model = AutoModelForCausalLM.from_config(config, torch_dtype=torch_dtype, **config_kwargs)
+
+    stored_keys = read_header(path)[0].keys()
+    state_dict = load_mmap_state_dict(path, shard_keys(stored_keys, layer_range, include_lm_head))
+    full_model.load_state_dict(state_dict, strict=False, assign=True)
+    if getattr(config, "tie_word_embeddings", False):
+        full_model.tie_weights()
+    full_model.eval()
+
+    logger.info(f"Mapped {len(state_dict)} tensors read-only from {path}")
+    return full_model
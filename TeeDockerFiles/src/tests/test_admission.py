@@ -0,0 +1,184 @@
+"""
+AdmissionController under concurrent requests: FIFO order with head-of-line blocking,
+the token budget, oversized requests, 429 on a full queue, 503 on deadline expiry in
+the queue, and the Retry-After estimate.
+"""
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+SRC = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(SRC, "app1"))
+
+from admission import AdmissionController, AdmissionRejected, Deadline  # noqa: E402
+
+SETTLE = 0.1  # Long enough for a blocked waiter to have been admitted if it could be
+
+
+class Waiter(threading.Thread):
+    """A request thread that queues for admission and records when it got in"""
+
+    def __init__(self, controller, cost, timeout=10.0, admitted=None):
+        super().__init__(daemon=True)
+        self.controller = controller
+        self.cost = cost
+        self.timeout = timeout
+        self.admitted = admitted if admitted is not None else []
+        self.ticket = None
+        self.error = None
+        self.done = threading.Event()
+
+    def run(self):
+        try:
+            self.ticket = self.controller.acquire(self.cost, Deadline(self.timeout))
+            self.admitted.append(self)
+        except AdmissionRejected as e:
+            self.error = e
+        finally:
+            self.done.set()
+
+
+def queue(controller, cost, **kwargs):
+    """Start a waiter and return once it is queued, so waiters queue in call order"""
+    depth = controller.stats()["queue_depth"]
+    waiter = Waiter(controller, cost, **kwargs)
+    waiter.start()
+    deadline = time.monotonic() + 5
+    while controller.stats()["queue_depth"] == depth and not waiter.done.is_set():
+        assert time.monotonic() < deadline, "waiter never queued"
+        time.sleep(0.005)
+    return waiter
+
+
+def admitted_after(waiter):
+    assert waiter.done.wait(5), "waiter was never admitted"
+    assert waiter.error is None
+    return waiter.ticket
+
+
+def test_fifo_order():
+    controller = AdmissionController(max_concurrent=1, max_queue=8)
+    running = controller.acquire(1, Deadline(10))
+    admitted = []
+    waiters = [queue(controller, 1, admitted=admitted) for _ in range(4)]
+
+    for index, waiter in enumerate(waiters):
+        running.release()
+        running = admitted_after(waiter)
+        assert admitted == waiters[:index + 1]
+    running.release()
+    assert controller.stats()["running"] == 0
+
+
+def test_head_of_line_blocks_smaller_requests():
+    controller = AdmissionController(max_concurrent=4, token_budget=100)
+    running = controller.acquire(60, Deadline(10))
+    big = queue(controller, 50)
+    small = queue(controller, 10)
+
+    # The small request would fit the budget but must not overtake the one ahead of it
+    time.sleep(SETTLE)
+    assert not big.done.is_set() and not small.done.is_set()
+
+    running.release()
+    admitted_after(big)
+    admitted_after(small)
+    assert controller.stats()["in_flight_cost"] == 60
+
+
+def test_token_budget():
+    controller = AdmissionController(max_concurrent=4, token_budget=100)
+    first = controller.acquire(40, Deadline(10))
+    second = controller.acquire(60, Deadline(10))  # Exactly fills the budget
+    waiter = queue(controller, 1)
+
+    time.sleep(SETTLE)
+    assert not waiter.done.is_set()
+    first.release()
+    admitted_after(waiter)
+    assert controller.stats()["in_flight_cost"] == 61
+
+    second.release()
+    waiter.ticket.release()
+    assert controller.stats()["in_flight_cost"] == 0
+
+
+def test_oversized_request_runs_alone():
+    controller = AdmissionController(max_concurrent=4, token_budget=100)
+    small = controller.acquire(10, Deadline(10))
+    oversized = queue(controller, 500)
+
+    time.sleep(SETTLE)
+    assert not oversized.done.is_set()
+    small.release()
+    ticket = admitted_after(oversized)
+
+    # Nothing else runs beside it, however small
+    follower = queue(controller, 1)
+    time.sleep(SETTLE)
+    assert not follower.done.is_set()
+    ticket.release()
+    admitted_after(follower)
+
+
+def test_full_queue_rejected_with_429():
+    controller = AdmissionController(max_concurrent=1, max_queue=2)
+    running = controller.acquire(1, Deadline(10))
+    waiters = [queue(controller, 1) for _ in range(2)]
+
+    with pytest.raises(AdmissionRejected) as excinfo:
+        controller.acquire(1, Deadline(10))
+    assert excinfo.value.status_code == 429
+    assert excinfo.value.retry_after >= 1
+    assert controller.stats()["rejected_total"] == 1
+
+    for waiter in waiters:
+        running.release()
+        running = admitted_after(waiter)
+    running.release()
+
+
+def test_deadline_expiry_in_queue_gives_503():
+    controller = AdmissionController(max_concurrent=1)
+    running = controller.acquire(1, Deadline(10))
+    expiring = queue(controller, 1, timeout=0.2)
+    behind = queue(controller, 1)
+
+    assert expiring.done.wait(5)
+    assert expiring.error.status_code == 503
+    assert expiring.error.retry_after >= 1
+    assert controller.stats()["expired_total"] == 1
+    assert controller.stats()["queue_depth"] == 1
+
+    # The expired request leaves the queue without blocking the one behind it
+    running.release()
+    admitted_after(behind).release()
+
+
+def test_retry_after_scales_with_queue_and_service_time():
+    controller = AdmissionController(max_concurrent=2, max_queue=3)
+    assert controller.retry_after() == 1  # No service time measured yet
+
+    controller.avg_service = 4.0
+    running = [controller.acquire(1, Deadline(10)) for _ in range(2)]
+    waiters = [queue(controller, 1) for _ in range(3)]
+    # Four requests (three queued plus this one) served two at a time, 4s each
+    with pytest.raises(AdmissionRejected) as excinfo:
+        controller.acquire(1, Deadline(10))
+    assert excinfo.value.retry_after == 8
+
+    for ticket in running:
+        ticket.release()
+    for waiter in waiters:
+        admitted_after(waiter).release()
+
+
+def test_release_is_idempotent():
+    controller = AdmissionController(max_concurrent=1)
+    with controller.acquire(5, Deadline(10)) as ticket:
+        ticket.release()
+    assert controller.stats()["running"] == 0
+    assert controller.stats()["in_flight_cost"] == 0
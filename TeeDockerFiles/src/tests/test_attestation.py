@@ -0,0 +1,83 @@
+"""
+Batched attestations must verify end to end: every leaf's inclusion proof leads to the
+Merkle root, and the root is what the dstack SDK puts in a quote's REPORTDATA when
+generate_ra.js passes it in raw mode.
+"""
+import os
+import sys
+
+import pytest
+
+SRC = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(SRC, "app1"), os.path.join(SRC, "app2")]
+
+from attestation import (  # noqa: E402
+    REPORT_DATA_OFFSET,
+    AttestationAggregator,
+    AttestationVerificationError,
+    build_merkle_levels,
+    inclusion_proof,
+    leaf_hash,
+    root_from_proof,
+    verify_attestation,
+)
+
+
+def sdk_tdx_quote(report_data, hash_algorithm):
+    """A quote as TappdClient.tdxQuote builds its REPORTDATA: hex of the data, left-padded in raw mode"""
+    data_hex = report_data.hex() if isinstance(report_data, bytes) else report_data.encode("utf-8").hex()
+    assert hash_algorithm == "raw"
+    if len(data_hex) > 128:
+        raise ValueError("Report data is too large")
+    return "00" * REPORT_DATA_OFFSET + data_hex.zfill(128) + "ab" * 64
+
+
+def get_ra_data(user_data, hash_algorithm):
+    """The apps' get_ra_data, with what generate_ra.js hands to the SDK: raw hex as the bytes it encodes"""
+    report_data = bytes.fromhex(user_data) if hash_algorithm == "raw" else user_data
+    ra_report = {"quote": sdk_tdx_quote(report_data, hash_algorithm), "event_log": "[]"}
+    return {"ra_report": ra_report, "custom_data_used": user_data}
+
+
+def records(count):
+    return [{"node": "node2", "prompt_hash": f"{i:064x}", "output_hash": f"{i + 1:064x}"} for i in range(count)]
+
+
+@pytest.mark.parametrize("count", range(1, 18))
+def test_proofs_lead_to_root(count):
+    leaves = [leaf_hash(record) for record in records(count)]
+    levels = build_merkle_levels(leaves)
+    root = levels[-1][0]
+    for index, leaf in enumerate(leaves):
+        assert root_from_proof(leaf, inclusion_proof(levels, index)) == root
+
+
+@pytest.mark.parametrize("count", [1, 2, 3, 8, 13])
+def test_aggregated_attestations_verify(count):
+    aggregator = AttestationAggregator(get_ra_data, window=5.0, max_batch=count)
+    batch = records(count)
+    futures = [aggregator.submit(record) for record in batch]
+    attestations = [future.result(timeout=10) for future in futures]
+
+    assert aggregator.stats()["quotes"] == 1
+    for record, attestation in zip(batch, attestations):
+        assert verify_attestation(attestation) == record
+
+
+def test_root_passed_as_string_does_not_verify():
+    # The SDK hex-encodes a string's UTF-8, so REPORTDATA would hold the ASCII of the hex
+    def string_ra(user_data, hash_algorithm):
+        return {"ra_report": {"quote": sdk_tdx_quote(user_data, hash_algorithm)}}
+
+    attestation = AttestationAggregator(string_ra, window=0.0).attest(records(1)[0], timeout=10)
+    with pytest.raises(AttestationVerificationError, match="report data"):
+        verify_attestation(attestation)
+
+
+def test_tampered_record_does_not_verify():
+    aggregator = AttestationAggregator(get_ra_data, window=5.0, max_batch=2)
+    futures = [aggregator.submit(record) for record in records(2)]
+    attestation = futures[1].result(timeout=10)
+    attestation["merkle"]["record"]["output_hash"] = "0" * 64
+    with pytest.raises(AttestationVerificationError, match="leaf"):
+        verify_attestation(attestation)
@@ -0,0 +1,91 @@
+"""
+Streamed text deltas must join to exactly the full decode of the generated ids, with no
+partial characters on the way and no word-boundary spaces lost between steps.
+"""
+import os
+import sys
+
+import pytest
+import torch
+from tokenizers import Tokenizer, decoders, models, normalizers
+from transformers import PreTrainedTokenizerFast
+
+SRC = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(SRC, "app2"))
+
+from detokenization import IncrementalDetokenizer  # noqa: E402
+
+TEXTS = [
+    "hello world",
+    "héllo wörld",
+    "😀 hello 日本語 world 😀😀",
+    "a  b   hello\tworld",
+    "wörld",
+]
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    """A small SentencePiece-style tokenizer: "▁" word boundaries and byte fallback for the rest"""
+    merges = [("▁", "h"), ("▁h", "e"), ("l", "l"), ("ll", "o"), ("▁he", "llo"),
+              ("▁", "w"), ("▁w", "o"), ("▁wo", "r"), ("l", "d"), ("▁wor", "ld")]
+    pieces = ["<unk>", "<s>", "</s>"] + [f"<0x{b:02X}>" for b in range(256)]
+    pieces += ["▁", "é"] + [chr(c) for c in range(ord("a"), ord("z") + 1)] + [a + b for a, b in merges]
+    vocab = {piece: index for index, piece in enumerate(dict.fromkeys(pieces))}
+
+    backend = Tokenizer(models.BPE(vocab=vocab, merges=merges, unk_token="<unk>", byte_fallback=True))
+    backend.normalizer = normalizers.Sequence([normalizers.Prepend("▁"), normalizers.Replace(" ", "▁")])
+    backend.decoder = decoders.Sequence([
+        decoders.Replace("▁", " "), decoders.ByteFallback(), decoders.Fuse(), decoders.Strip(" ", 1, 0),
+    ])
+    return PreTrainedTokenizerFast(tokenizer_object=backend, bos_token="<s>", eos_token="</s>", unk_token="<unk>")
+
+
+def stream_deltas(tokenizer, token_ids):
+    detokenizer = IncrementalDetokenizer(tokenizer)
+    deltas = [detokenizer.add([token_id]) for token_id in token_ids]
+    deltas.append(detokenizer.flush())
+    return deltas, detokenizer
+
+
+@pytest.mark.parametrize("text", TEXTS)
+def test_deltas_match_full_decode(tokenizer, text):
+    token_ids = tokenizer.encode(text, add_special_tokens=False)
+    deltas, detokenizer = stream_deltas(tokenizer, token_ids)
+
+    assert "".join(deltas) == tokenizer.decode(token_ids) == text
+    assert detokenizer.text == text
+    assert not any("�" in delta for delta in deltas)
+
+
+def test_multibyte_character_held_back_until_complete(tokenizer):
+    token_ids = tokenizer.encode("😀", add_special_tokens=False)
+    assert len(token_ids) > 2  # Spread over byte-fallback tokens
+
+    deltas, _ = stream_deltas(tokenizer, token_ids)
+    assert [delta for delta in deltas if delta] == ["😀"]
+    assert deltas.index("😀") == len(token_ids) - 1
+
+
+def test_word_boundary_spaces_kept(tokenizer):
+    token_ids = tokenizer.encode("hello world", add_special_tokens=False)
+    # Decoding a step on its own strips the leading "▁" space
+    assert tokenizer.decode(token_ids[1:]) == "world"
+
+    deltas, _ = stream_deltas(tokenizer, token_ids)
+    assert deltas[:2] == ["hello", " world"]
+
+
+def test_truncated_character_flushed(tokenizer):
+    token_ids = tokenizer.encode("hi 😀", add_special_tokens=False)[:-1]
+    deltas, _ = stream_deltas(tokenizer, token_ids)
+    assert "".join(deltas) == tokenizer.decode(token_ids)
+
+
+def test_stream_skips_special_tokens(tokenizer):
+    token_ids = tokenizer.encode("héllo wörld", add_special_tokens=False) + [tokenizer.eos_token_id]
+    steps = (torch.tensor([[token_id]]) for token_id in token_ids)
+
+    deltas = list(IncrementalDetokenizer(tokenizer).stream(steps))
+    assert all(deltas)
+    assert "".join(deltas) == "héllo wörld"
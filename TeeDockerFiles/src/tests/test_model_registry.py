@@ -0,0 +1,195 @@
+"""
+ModelRegistry with a fake loader: models load lazily in the background, idle ones are
+evicted least recently used first under the memory budget (never in-use or pinned ones),
+failed loads back off, and loading requests get a Retry-After estimate.
+"""
+import os
+import sys
+import threading
+import time
+
+import pytest
+import torch
+
+SRC = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(SRC, "app1"))
+
+from model_registry import (  # noqa: E402
+    HostedModel,
+    ModelLoading,
+    ModelRegistry,
+    ModelSpec,
+    ModelUnavailable,
+    UnknownModel,
+)
+
+SHARD_BYTES = 100
+
+
+class FakeShard(torch.nn.Module):
+    def __init__(self, size):
+        super().__init__()
+        self.register_buffer("weights", torch.zeros(size, dtype=torch.uint8))
+
+
+class FakeLoader:
+    """Builds SHARD_BYTES shards; `gate` holds loads back and `failing` ids raise"""
+
+    def __init__(self, failing=()):
+        self.calls = []
+        self.failing = set(failing)
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def __call__(self, spec):
+        self.calls.append(spec.model_id)
+        assert self.gate.wait(5)
+        if spec.model_id in self.failing:
+            raise OSError(f"no weights for {spec.model_id}")
+        return HostedModel(spec, FakeShard(SHARD_BYTES), f"hash-{spec.model_id}", {})
+
+
+def make_registry(loader, model_ids=("b", "c", "d"), **kwargs):
+    specs = {model_id: ModelSpec(model_id, f"/models/{model_id}") for model_id in ("default",) + tuple(model_ids)}
+    registry = ModelRegistry(specs, loader, "node1", "default", **kwargs)
+    registry.add_loaded(HostedModel(specs["default"], FakeShard(SHARD_BYTES), "hash-default", {}))
+    return registry
+
+
+def drain(registry):
+    """Wait for queued loads; they run one at a time on the registry's loader thread"""
+    registry._executor.submit(lambda: None).result(5)
+
+
+def load(registry, model_id):
+    with pytest.raises(ModelLoading):
+        registry.acquire(model_id)
+    drain(registry)
+    return registry.acquire(model_id)
+
+
+def loaded_ids(registry):
+    return {model_id for model_id, entry in registry.stats()["models"].items() if entry["loaded"]}
+
+
+def test_loads_lazily_once():
+    loader = FakeLoader()
+    loader.gate.clear()
+    registry = make_registry(loader)
+    assert loader.calls == []
+    assert registry.acquire().model_id == "default"
+
+    # Requests arriving while the model loads are turned away without starting another load
+    for _ in range(3):
+        with pytest.raises(ModelLoading):
+            registry.acquire("b")
+    assert registry.stats()["models"]["b"]["loading"]
+    loader.gate.set()
+    drain(registry)
+
+    hosted = registry.acquire("b")
+    assert hosted.model_hash == "hash-b" and hosted.in_use == 1
+    assert loader.calls == ["b"]
+    assert registry.loads == 1 and registry.avg_load_s is not None
+    registry.release(hosted)
+
+
+def test_unknown_model():
+    registry = make_registry(FakeLoader())
+    with pytest.raises(UnknownModel):
+        registry.acquire("nope")
+
+
+def test_evicts_least_recently_used_under_budget():
+    registry = make_registry(FakeLoader(), memory_budget=3 * SHARD_BYTES)
+    b = load(registry, "b")
+    registry.release(b)
+    c = load(registry, "c")
+    registry.release(c)
+    time.sleep(0.01)
+    registry.release(registry.acquire("b"))  # b is now more recently used than c
+
+    registry.release(load(registry, "d"))
+    assert loaded_ids(registry) == {"default", "b", "d"}
+    assert registry.evictions == 1
+    assert c.model is None  # Freed
+
+
+def test_never_evicts_in_use_or_pinned():
+    registry = make_registry(FakeLoader(), memory_budget=2 * SHARD_BYTES)
+    b = load(registry, "b")
+
+    # Loading c goes over budget, but b is in use and the default model is pinned
+    c = load(registry, "c")
+    assert loaded_ids(registry) == {"default", "b", "c"}
+    assert registry.evictions == 0
+
+    # Once c is idle, releasing it brings usage back within budget
+    registry.release(c)
+    assert loaded_ids(registry) == {"default", "b"}
+
+    # b can go once it is idle; the pinned default never does
+    registry.release(b)
+    registry.release(load(registry, "d"))
+    assert loaded_ids(registry) == {"default", "d"}
+    assert registry.evictions == 2
+    assert registry.get_loaded("default").model is not None
+
+
+def test_failed_load_backs_off():
+    loader = FakeLoader(failing={"b"})
+    registry = make_registry(loader, retry_failed_after=0.2)
+    with pytest.raises(ModelLoading):
+        registry.acquire("b")
+    drain(registry)
+
+    # Refused without another load attempt until the backoff passes
+    for _ in range(3):
+        with pytest.raises(ModelUnavailable) as excinfo:
+            registry.acquire("b")
+        assert not isinstance(excinfo.value, ModelLoading)
+        assert "no weights for b" in str(excinfo.value)
+    assert loader.calls == ["b"]
+    assert registry.stats()["models"]["b"]["retry_in_s"] <= 0.2
+
+    time.sleep(0.25)
+    loader.failing.clear()
+    hosted = load(registry, "b")
+    assert loader.calls == ["b", "b"]
+    assert "last_error" not in registry.stats()["models"]["b"]
+    registry.release(hosted)
+
+
+def test_hash_mismatch_is_a_failed_load():
+    loader = FakeLoader()
+    registry = make_registry(loader)
+    registry.specs["b"].expected_hash = {"node1": "deadbeef", "node2": "hash-b"}
+    with pytest.raises(ModelLoading):
+        registry.acquire("b")
+    drain(registry)
+    with pytest.raises(ModelUnavailable, match="failed verification"):
+        registry.acquire("b")
+    assert "b" not in loaded_ids(registry)
+
+
+def test_retry_after_counts_loads_ahead():
+    loader = FakeLoader()
+    registry = make_registry(loader)
+    with pytest.raises(ModelLoading) as excinfo:
+        registry.acquire("b")
+    assert excinfo.value.retry_after == 30  # No load measured yet
+    drain(registry)
+
+    registry.avg_load_s = 10.0
+    loader.gate.clear()
+    with pytest.raises(ModelLoading) as first:
+        registry.acquire("c")
+    time.sleep(0.01)
+    with pytest.raises(ModelLoading) as second:
+        registry.acquire("d")
+    assert first.value.retry_after == 10
+    assert second.value.retry_after == 20  # Queued behind c on the single loader thread
+
+    loader.gate.set()
+    drain(registry)
+    assert loaded_ids(registry) == {"default", "b", "c", "d"}
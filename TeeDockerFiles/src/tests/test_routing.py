@@ -0,0 +1,180 @@
+"""
+Node2Pool against local stand-in replicas: failover when a replica never took the
+request, Retry-After declines, pinned sessions that must not move, and registry re-reads.
+"""
+import json
+import os
+import socket
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+SRC = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(SRC, "app1"))
+
+from routing import Node2Pool, NoReplicaAvailable  # noqa: E402
+
+
+class StandIn:
+    """An HTTP server answering every request with `status` (and `headers`), counting POSTs"""
+
+    def __init__(self, status=200, headers=None, body=None):
+        self.status = status
+        self.headers = headers or {}
+        self.body = body
+        self.posts = 0
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _reply(self, status, headers, body):
+                payload = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                self._reply(200, {}, stand_in.body if stand_in.body is not None else {"status": "healthy"})
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                stand_in.posts += 1
+                self._reply(stand_in.status, stand_in.headers, {"output": stand_in.url})
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stand_ins():
+    servers = []
+
+    def make(*args, **kwargs):
+        servers.append(StandIn(*args, **kwargs))
+        return servers[-1]
+
+    yield make
+    for server in servers:
+        server.close()
+
+
+def unused_url():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return f"http://127.0.0.1:{sock.getsockname()[1]}"
+
+
+def replica(pool, url):
+    return next(r for r in pool.replicas() if r.url == url)
+
+
+def test_fails_over_connection_errors(stand_ins):
+    live = stand_ins()
+    dead_url = unused_url()
+    pool = Node2Pool(urls=[dead_url, live.url], failure_threshold=1)
+    # The dead replica is the first choice until it fails
+    replica(pool, live.url).outstanding = 1
+
+    assert pool.post("/generate", {}, timeout=5).json() == {"output": live.url}
+    assert not replica(pool, dead_url).healthy
+    assert replica(pool, dead_url).consecutive_failures == 1
+
+
+@pytest.mark.parametrize("status", [502, 503])
+def test_fails_over_gateway_errors(stand_ins, status):
+    failing, live = stand_ins(status), stand_ins()
+    pool = Node2Pool(urls=[failing.url, live.url])
+    replica(pool, live.url).outstanding = 1
+
+    assert pool.post("/generate", {}, timeout=5).json() == {"output": live.url}
+    assert failing.posts == 1
+    assert replica(pool, failing.url).consecutive_failures == 1
+
+
+def test_skips_replica_until_retry_after(stand_ins):
+    loading, live = stand_ins(503, {"Retry-After": "30"}), stand_ins()
+    pool = Node2Pool(urls=[loading.url, live.url])
+    replica(pool, live.url).outstanding = 1
+
+    for _ in range(3):
+        assert pool.post("/generate", {}, timeout=5).json() == {"output": live.url}
+    # Declined once, then left alone for the Retry-After period without counting as a failure
+    assert loading.posts == 1
+    declined = replica(pool, loading.url)
+    assert declined.healthy and declined.consecutive_failures == 0
+
+    declined.declined_until = 0.0
+    replica(pool, live.url).outstanding = 5
+    pool.post("/generate", {}, timeout=5)
+    assert loading.posts == 2
+
+
+def test_every_replica_declining_gives_retry_after(stand_ins):
+    loading = stand_ins(503, {"Retry-After": "12"})
+    pool = Node2Pool(urls=[loading.url])
+
+    for _ in range(2):
+        with pytest.raises(NoReplicaAvailable) as excinfo:
+            pool.post("/generate", {}, timeout=5)
+        assert excinfo.value.retry_after in (11, 12)
+    assert loading.posts == 1
+
+
+def test_pinned_session_does_not_move(stand_ins):
+    first, second = stand_ins(), stand_ins()
+    pool = Node2Pool(urls=[first.url, second.url])
+    replica(pool, second.url).outstanding = 1
+
+    session = pool.session()
+    assert session.post("/prefill", {}, timeout=5).json() == {"output": first.url}
+    replica(pool, second.url).outstanding = 0
+
+    first.status = 503
+    with pytest.raises(NoReplicaAvailable):
+        session.post("/prefill", {}, timeout=5)
+    assert first.posts == 2
+    assert second.posts == 0
+    assert session.replica.url == first.url
+
+
+def test_rereads_file_registry(tmp_path):
+    path = tmp_path / "replicas.json"
+    path.write_text(json.dumps({"replicas": ["http://a:5001", "http://b:5001/"]}))
+    pool = Node2Pool(registry=str(path))
+    assert {r.url for r in pool.replicas()} == {"http://a:5001", "http://b:5001"}
+
+    kept = replica(pool, "http://b:5001")
+    path.write_text(json.dumps(["http://b:5001", "http://c:5001"]))
+    os.utime(path, (0, 12345))  # The mtime tells the pool the file changed
+    pool.refresh()
+    assert {r.url for r in pool.replicas()} == {"http://b:5001", "http://c:5001"}
+    assert replica(pool, "http://b:5001") is kept
+
+    # An unreadable registry keeps the last known replicas
+    path.write_text("{not json")
+    os.utime(path, (0, 23456))
+    pool.refresh()
+    assert {r.url for r in pool.replicas()} == {"http://b:5001", "http://c:5001"}
+
+
+def test_rereads_http_registry(stand_ins):
+    registry = stand_ins(body={"replicas": ["http://a:5001"]})
+    pool = Node2Pool(urls=["http://static:5001"], registry=registry.url)
+    assert {r.url for r in pool.replicas()} == {"http://static:5001", "http://a:5001"}
+
+    registry.body = {"replicas": []}
+    pool.refresh()
+    assert {r.url for r in pool.replicas()} == {"http://static:5001"}
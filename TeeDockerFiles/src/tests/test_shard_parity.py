@@ -0,0 +1,88 @@
+"""
+Node1Model -> Node2Model must produce the same logits as the unsplit model, for a
+one-shot prefill, a prefill split into chunks over a KV cache, and cached decode steps.
+"""
+import copy
+import os
+import sys
+
+import pytest
+import torch
+from transformers import DynamicCache, LlamaConfig, LlamaForCausalLM
+
+SRC = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(SRC, "app1"), os.path.join(SRC, "app2")]
+
+from node1_model import Node1Model  # noqa: E402
+from node2_model import Node2Model  # noqa: E402
+
+ATOL = 1e-5
+
+
+@pytest.fixture(scope="module")
+def full_model():
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=128,
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=4,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=256,
+        attn_implementation="sdpa",
+    )
+    return LlamaForCausalLM(config).eval()
+
+
+@pytest.fixture
+def shards(full_model):
+    # Node2Model renumbers its layers' cache slots, so split a copy
+    base = copy.deepcopy(full_model)
+    middle = base.config.num_hidden_layers // 2
+    return Node1Model(base, middle), Node2Model(base, middle)
+
+
+@pytest.fixture
+def input_ids(full_model):
+    generator = torch.Generator().manual_seed(1)
+    return torch.randint(0, full_model.config.vocab_size, (1, 13), generator=generator)
+
+
+def run_split(shards, input_ids, node1_cache=None, node2_cache=None):
+    node1, node2 = shards
+    hidden_states = node1(input_ids, past_key_values=node1_cache, output_hidden_states=False).last_hidden_state
+    return node2(hidden_states, past_key_values=node2_cache, output_hidden_states=False).logits
+
+
+@torch.no_grad()
+def test_one_shot_prefill(full_model, shards, input_ids):
+    expected = full_model(input_ids).logits
+    torch.testing.assert_close(run_split(shards, input_ids), expected, atol=ATOL, rtol=0)
+
+
+@torch.no_grad()
+@pytest.mark.parametrize("chunk_size", [1, 4, 5])
+def test_chunked_prefill(full_model, shards, input_ids, chunk_size):
+    expected = full_model(input_ids).logits
+    node1_cache, node2_cache = DynamicCache(), DynamicCache()
+    logits = [
+        run_split(shards, input_ids[:, start:start + chunk_size], node1_cache, node2_cache)
+        for start in range(0, input_ids.shape[1], chunk_size)
+    ]
+    torch.testing.assert_close(torch.cat(logits, dim=1), expected, atol=ATOL, rtol=0)
+    assert node1_cache.get_seq_length() == node2_cache.get_seq_length() == input_ids.shape[1]
+
+
+@torch.no_grad()
+def test_cached_decode(full_model, shards, input_ids):
+    full_cache, node1_cache, node2_cache = DynamicCache(), DynamicCache(), DynamicCache()
+    expected = full_model(input_ids, past_key_values=full_cache, use_cache=True).logits[:, -1:]
+    logits = run_split(shards, input_ids, node1_cache, node2_cache)[:, -1:]
+
+    for _ in range(6):
+        torch.testing.assert_close(logits, expected, atol=ATOL, rtol=0)
+        next_token = expected.argmax(dim=-1)
+        expected = full_model(next_token, past_key_values=full_cache, use_cache=True).logits
+        logits = run_split(shards, next_token, node1_cache, node2_cache)
+    torch.testing.assert_close(logits, expected, atol=ATOL, rtol=0)
@@ -0,0 +1,80 @@
+"""
+ChatTokenizer must return exactly what rendering the chat template and encoding it
+returns, for single prompts and batches, and must not take the fast path where BPE can
+merge across the template/content boundary unless told to.
+"""
+import os
+import sys
+
+import pytest
+from tokenizers import Tokenizer, models
+from transformers import PreTrainedTokenizerFast
+
+SRC = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(SRC, "app1"))
+
+from tokenization import PROBE_PROMPTS, ChatTokenizer  # noqa: E402
+
+SPECIAL_TEMPLATE = (
+    "{% for m in messages %}<|user|>{{ m['content'] }}<|end|>{% endfor %}"
+    "{% if add_generation_prompt %}<|assistant|>{% endif %}"
+)
+PLAIN_TEMPLATE = (
+    "{% for m in messages %}User:{{ m['content'] }}\n{% endfor %}"
+    "{% if add_generation_prompt %}Bot:{% endif %}"
+)
+# ")" merges with the ":" that ends the plain template's prefix, which no probe prompt contains
+CONTENTS = ["Hi", ")Hi there", "Hi:)", "", "  spaced  ", "日本語 😀", "<|end|>"]
+
+
+def make_tokenizer(chat_template):
+    """BPE over the whole string (no pre-tokenizer) with byte fallback and a few merges"""
+    merges = [("H", "i"), (":", ")"), ("e", "r"), ("t", "h")]
+    pieces = ["<unk>"] + [f"<0x{b:02X}>" for b in range(256)] + [chr(c) for c in range(32, 127)]
+    pieces += [a + b for a, b in merges]
+    vocab = {piece: index for index, piece in enumerate(dict.fromkeys(pieces))}
+    backend = Tokenizer(models.BPE(vocab=vocab, merges=merges, unk_token="<unk>", byte_fallback=True))
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=backend, unk_token="<unk>")
+    tokenizer.add_special_tokens({"additional_special_tokens": ["<|user|>", "<|end|>", "<|assistant|>"]})
+    tokenizer.chat_template = chat_template
+    return tokenizer
+
+
+def test_special_token_boundaries_use_fast_path():
+    chat_tokenizer = ChatTokenizer(make_tokenizer(SPECIAL_TEMPLATE))
+    assert chat_tokenizer.exact_boundaries and chat_tokenizer.fast_path
+    for content in CONTENTS:
+        assert chat_tokenizer.encode(content) == chat_tokenizer.encode_slow(content)
+
+
+def test_plain_text_boundary_uses_slow_path():
+    chat_tokenizer = ChatTokenizer(make_tokenizer(PLAIN_TEMPLATE))
+    assert not chat_tokenizer.exact_boundaries and not chat_tokenizer.fast_path
+    for content in CONTENTS:
+        assert chat_tokenizer.encode(content) == chat_tokenizer.encode_slow(content)
+
+
+def test_probe_mode_can_differ_across_boundary():
+    # The probes pass, yet a merge across the boundary changes the ids: why "exact" is the default
+    chat_tokenizer = ChatTokenizer(make_tokenizer(PLAIN_TEMPLATE), mode="probe")
+    assert chat_tokenizer.fast_path
+    assert chat_tokenizer.encode("Hi") == chat_tokenizer.encode_slow("Hi")
+    assert chat_tokenizer.encode(")Hi") != chat_tokenizer.encode_slow(")Hi")
+
+
+def test_unknown_mode_rejected():
+    with pytest.raises(ValueError):
+        ChatTokenizer(make_tokenizer(SPECIAL_TEMPLATE), mode="fast")
+
+
+@pytest.mark.parametrize("template", [SPECIAL_TEMPLATE, PLAIN_TEMPLATE])
+def test_encode_batch_matches_encode(template):
+    chat_tokenizer = ChatTokenizer(make_tokenizer(template), max_workers=2)
+    # Enough distinct contents to split across the thread pool, with repeats
+    contents = [f"{content} #{i}" for i in range(6) for content in CONTENTS] + CONTENTS * 2
+
+    assert chat_tokenizer.encode_batch(contents) == [chat_tokenizer.encode_slow(c) for c in contents]
+    if chat_tokenizer.fast_path:
+        # Each distinct content is cached once, next to the probes from compiling the template
+        assert chat_tokenizer.cache_info()["size"] == len(set(contents) | set(PROBE_PROMPTS))
+        assert chat_tokenizer.encode_batch(CONTENTS) == [chat_tokenizer.encode(c) for c in CONTENTS]
@@ -0,0 +1,51 @@
+"""
+The weight store is written tensor by tensor; it must stay a valid safetensors file that
+both safetensors and the memory-mapped loader read back exactly.
+"""
+import os
+import sys
+
+import pytest
+import torch
+from safetensors.torch import load_file
+
+SRC = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(SRC, "app1"), os.path.join(SRC, "app2")]
+
+from weight_store import load_mmap_state_dict, remove_stale_temp_files, write_store  # noqa: E402
+
+
+class Weights(torch.nn.Module):
+    def __init__(self, dtype):
+        super().__init__()
+        self.embed = torch.nn.Parameter(torch.randn(7, 3).to(dtype))
+        self.odd = torch.nn.Parameter(torch.randn(5).to(dtype))  # Leaves the next tensor unaligned
+        self.lm_head = self.embed  # Tied, stored once
+        self.register_buffer("scale", torch.tensor(2.0, dtype=dtype))
+        self.register_buffer("mask", torch.tensor([True, False, True]))
+        self.register_buffer("steps", torch.arange(4))
+
+
+@pytest.mark.parametrize("dtype", [torch.float16, torch.bfloat16, torch.float32])
+def test_store_round_trip(tmp_path, dtype):
+    model = Weights(dtype)
+    path = str(tmp_path / "model.safetensors")
+    write_store(model, path)
+
+    expected = {name: tensor for name, tensor in model.state_dict().items() if name != "lm_head"}
+    for loaded in (load_file(path), load_mmap_state_dict(path)):
+        assert loaded.keys() == expected.keys()
+        for name, tensor in expected.items():
+            assert loaded[name].dtype == tensor.dtype
+            assert torch.equal(loaded[name], tensor)
+
+    assert os.stat(path).st_mode & 0o777 == 0o644
+    assert os.listdir(tmp_path) == ["model.safetensors"]
+
+
+def test_stale_temp_files_removed(tmp_path):
+    path = str(tmp_path / "model.safetensors")
+    for name in ("model.safetensors.abc123.tmp", "other.safetensors.abc123.tmp"):
+        (tmp_path / name).write_bytes(b"partial")
+    remove_stale_temp_files(path)
+    assert os.listdir(tmp_path) == ["other.safetensors.abc123.tmp"]
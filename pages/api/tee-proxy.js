@@ -4,7 +4,7 @@ export default async function handler(req, res) {
   }
 
   try {
-    const { prompt } = req.body;
+    const { prompt, model } = req.body;
 
     // Call the Node1 API to get hidden states and then Node2 to generate
     const response = await fetch(
@@ -14,7 +14,8 @@ export default async function handler(req, res) {
         headers: {
           "Content-Type": "application/json",
         },
-        body: JSON.stringify({ prompt }),
+        // Without a model the nodes use their default (TinyLlama)
+        body: JSON.stringify(model ? { prompt, model } : { prompt }),
       }
     );
 
@@ -3,11 +3,131 @@ import os
 import subprocess
 import json
 import time
+import fcntl
+import logging
+import mmap
+import struct
+import threading
+from contextlib import contextmanager
+
+DEBUG = os.environ.get("DEBUG", "false").lower() in ("1", "true", "yes")
+
+logging.basicConfig(level=logging.DEBUG if DEBUG else logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('phala-counter')
 
 app = Flask(__name__)
 
-# Initialize counter
-counter = 0
+# Counter state file: magic, value, reset count, last update time
+STATE_FORMAT = "<8sqqd"
+STATE_MAGIC = b"TEECNT01"
+STATE_SIZE = struct.calcsize(STATE_FORMAT)
+
+
+class CounterStore:
+    """
+    Counter kept in a memory-mapped file shared by every worker process.
+
+    Updates take a thread lock and an exclusive POSIX lock on the file, so they are atomic
+    across threads and across gunicorn workers, and the critical section is a few
+    microseconds. The mapping is written immediately (other workers see it at once);
+    msync to disk is batched by a background thread every `fsync_interval` seconds,
+    so at most that window of increments can be lost on a power failure. With
+    fsync_interval=0 every update is synced before it returns.
+    """
+
+    def __init__(self, path, fsync_interval=0.05):
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self._thread_lock = threading.Lock()
+        self._dirty = threading.Event()
+        self._flusher = None
+        self.flushes = 0
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        with self._locked():
+            if os.fstat(self._fd).st_size < STATE_SIZE:
+                os.ftruncate(self._fd, STATE_SIZE)
+            self._mm = mmap.mmap(self._fd, STATE_SIZE)
+            magic, _, _, _ = struct.unpack_from(STATE_FORMAT, self._mm)
+            if magic != STATE_MAGIC:
+                struct.pack_into(STATE_FORMAT, self._mm, 0, STATE_MAGIC, 0, 0, time.time())
+                self._mm.flush()
+        logger.info(f"Counter state at {path}: value={self.get()}")
+
+    @contextmanager
+    def _locked(self, shared=False):
+        # POSIX locks belong to the process (even across a fork with --preload), so
+        # threads of one process also need the thread lock
+        with self._thread_lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+    def _read(self):
+        _, value, resets, updated_at = struct.unpack_from(STATE_FORMAT, self._mm)
+        return value, resets, updated_at
+
+    def _write(self, value, resets):
+        struct.pack_into(STATE_FORMAT, self._mm, 0, STATE_MAGIC, value, resets, time.time())
+
+    def _written(self):
+        if self.fsync_interval <= 0:
+            self.flush()
+            return
+        if self._flusher is None:
+            with self._thread_lock:
+                # Started lazily so each gunicorn worker runs its own after forking
+                if self._flusher is None:
+                    self._flusher = threading.Thread(target=self._flush_loop, name="counter-fsync", daemon=True)
+                    self._flusher.start()
+        self._dirty.set()
+
+    def _flush_loop(self):
+        while True:
+            self._dirty.wait()
+            time.sleep(self.fsync_interval)
+            self._dirty.clear()
+            self.flush()
+
+    def flush(self):
+        self._mm.flush()
+        self.flushes += 1
+
+    def get(self):
+        with self._locked(shared=True):
+            return self._read()[0]
+
+    def add(self, delta=1):
+        with self._locked():
+            value, resets, _ = self._read()
+            value += delta
+            self._write(value, resets)
+        self._written()
+        return value
+
+    def reset(self):
+        with self._locked():
+            _, resets, _ = self._read()
+            self._write(0, resets + 1)
+        self._written()
+        return 0
+
+    def stats(self):
+        with self._locked(shared=True):
+            value, resets, updated_at = self._read()
+        return {
+            "value": value,
+            "resets": resets,
+            "updated_at": updated_at,
+            "path": self.path,
+            "fsync_interval_ms": int(self.fsync_interval * 1000),
+            "pending_fsync": self._dirty.is_set(),
+        }
+
 
 def get_ra_data(custom_data):
     """
@@ -28,6 +148,123 @@ def get_ra_data(custom_data):
     except json.JSONDecodeError as je:
         return {"error": "Invalid JSON returned from Node script", "details": str(je)}
 
+
+class AttestationCache:
+    """
+    Latest RA report over the counter, refreshed in the background every
+    `refresh_interval` seconds so requests never wait on the quote subprocess.
+    A report older than `max_age` is not served as current: the request refreshes
+    it synchronously instead, and requests that waited on that refresh reuse its
+    result. When refreshes fail, the outcome of the last attempt (the stale report,
+    or the error if there is none) is served until `refresh_interval` has passed,
+    so failing quotes never cost more than one subprocess per interval.
+    """
+
+    def __init__(self, store, refresh_interval=5.0, max_age=30.0):
+        self.store = store
+        self.refresh_interval = refresh_interval
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._entry = None  # (ra_data, counter value, generated_at)
+        self._last_attempt = None  # (entry served for it, completed_at, failed)
+        self._thread = None
+        self.refreshes = 0
+        self.failures = 0
+
+    def _refresh(self):
+        value = self.store.get()
+        generated_at = time.time()
+        ra_data = get_ra_data(f"counter:{value}, time:{generated_at}")
+        with self._lock:
+            self.refreshes += 1
+            failed = "error" in ra_data
+            if failed:
+                # Keep serving the previous report (marked stale by its age) if there is one
+                self.failures += 1
+                logger.warning(f"Attestation refresh failed: {ra_data.get('details')}")
+                result = self._entry or (ra_data, value, generated_at)
+            else:
+                result = self._entry = (ra_data, value, generated_at)
+            self._last_attempt = (result, time.time(), failed)
+            return result
+
+    def _usable(self, requested_at):
+        """An entry to serve without running a refresh, or None"""
+        with self._lock:
+            now = time.time()
+            if self._entry is not None and now - self._entry[2] <= self.max_age:
+                return self._entry
+            if self._last_attempt is not None:
+                result, completed_at, failed = self._last_attempt
+                # A refresh finished while this request waited, or one failed too recently to retry
+                if completed_at >= requested_at or (failed and now - completed_at < self.refresh_interval):
+                    return result
+            return None
+
+    def _refresh_loop(self):
+        while True:
+            try:
+                with self._refresh_lock:
+                    self._refresh()
+            except Exception as e:
+                logger.error(f"Attestation refresh error: {str(e)}")
+            time.sleep(self.refresh_interval)
+
+    def get(self):
+        """Return (ra_data, attested counter value, age in seconds)"""
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._refresh_loop, name="ra-refresh", daemon=True)
+                    self._thread.start()
+
+        requested_at = time.time()
+        entry = self._usable(requested_at)
+        if entry is None:
+            with self._refresh_lock:
+                entry = self._usable(requested_at)
+                if entry is None:
+                    entry = self._refresh()
+        ra_data, value, generated_at = entry
+        return ra_data, value, time.time() - generated_at
+
+    def stats(self):
+        with self._lock:
+            age = time.time() - self._entry[2] if self._entry else None
+            return {
+                "refresh_interval_s": self.refresh_interval,
+                "max_age_s": self.max_age,
+                "age_s": round(age, 3) if age is not None else None,
+                "refreshes": self.refreshes,
+                "failures": self.failures,
+            }
+
+
+counter = CounterStore(
+    os.environ.get("COUNTER_STATE_PATH", "/app/data/counter.bin"),
+    fsync_interval=float(os.environ.get("COUNTER_FSYNC_INTERVAL_MS", "50")) / 1000
+)
+attestation = AttestationCache(
+    counter,
+    refresh_interval=float(os.environ.get("ATTESTATION_REFRESH_S", "5")),
+    max_age=float(os.environ.get("ATTESTATION_MAX_AGE_S", "30"))
+)
+
+
+def counter_response(value, **extra):
+    """Counter value plus the cached RA report and the counter value it attests"""
+    ra_data, attested_value, age = attestation.get()
+    return jsonify({
+        "counter": value,
+        **extra,
+        **ra_data,
+        "attested_counter": attested_value,
+        "attestation_age_s": round(age, 3),
+        "attestation_stale": age > attestation.max_age
+    })
+
+
 @app.route("/", methods=["GET"])
 def home():
     return jsonify({
@@ -35,44 +272,31 @@ def home():
         "endpoints": {
             "/counter": "Get current counter value with RA report",
             "/counter/increment": "Increment the counter and get RA report",
-            "/counter/reset": "Reset the counter and get RA report"
+            "/counter/reset": "Reset the counter and get RA report",
+            "/stats": "Counter state and attestation cache status"
         }
     })
 
 @app.route("/counter", methods=["GET"])
 def get_counter():
-    # Build custom data from current counter and timestamp.
-    custom_data = f"counter:{counter}, time:{time.time()}"
-    ra_data = get_ra_data(custom_data)
-    return jsonify({
-        "counter": counter,
-        **ra_data
-    })
+    return counter_response(counter.get())
 
 @app.route("/counter/increment", methods=["GET", "POST"])
 def increment_counter():
-    global counter
-    counter += 1
-    custom_data = f"counter:{counter}, time:{time.time()}"
-    ra_data = get_ra_data(custom_data)
-    return jsonify({
-        "counter": counter,
-        "message": "Counter incremented",
-        **ra_data
-    })
+    return counter_response(counter.add(1), message="Counter incremented")
 
 @app.route("/counter/reset", methods=["GET", "POST"])
 def reset_counter():
-    global counter
-    counter = 0
-    custom_data = f"counter:{counter}, time:{time.time()}"
-    ra_data = get_ra_data(custom_data)
+    return counter_response(counter.reset(), message="Counter reset to 0")
+
+@app.route("/stats", methods=["GET"])
+def stats():
     return jsonify({
-        "counter": counter,
-        "message": "Counter reset to 0",
-        **ra_data
+        "counter": counter.stats(),
+        "attestation": attestation.stats(),
+        "pid": os.getpid()
     })
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
-    app.run(host="0.0.0.0", port=port, debug=True)
+    app.run(host="0.0.0.0", port=port, debug=DEBUG, threaded=True)